@@ -1,35 +1,112 @@
-"""Redwall - Console entrypoint"""
+"""Redwall - Console entrypoint
+
+Commands import the modules they need when invoked, so that short-lived
+commands, e.g. ``redwall current -f`` polled by a status bar, do not pay for
+importing PRAW, Requests, Pillow or screeninfo.
+"""
+# pylint: disable=import-outside-toplevel
 import logging
 import os
 import sys
 import time
 
 import click
-from screeninfo import get_monitors
-from sqlalchemy import create_engine
-from sqlalchemy.exc import OperationalError
-from sqlalchemy.orm import sessionmaker
 
 from .config import Config
-from .election import Chooser
-from .gathering import Gatherer
-from .models import Base, History, Submission
-from .stats import display_stats
 
+# commands that never write to the database
+READ_ONLY_COMMANDS = ("current", "export", "history", "info", "search")
+
+# number of functions printed by gather --profile
+PROFILE_LINES = 30
+
+# printed by random --background for images that have not been rendered yet
+DEFAULT_BACKGROUND_COLOR = "#000000"
+
+
+def open_database(config, read_only=False):
+    """Create or upgrade the database, and return a session factory
+
+    Read-only sessions are only returned if the database is up to date.
+    """
+    from sqlalchemy.exc import OperationalError
+    from sqlalchemy.orm import sessionmaker
+
+    from .db import create_db_engine, display_url
+    from .migrations import MIGRATIONS, migrate, schema_version
+
+    if read_only and (config.db_filename is None or os.path.exists(config.db_filename)):
+        engine = create_db_engine(config, read_only=True)
+
+        if schema_version(engine) >= len(MIGRATIONS):
+            return sessionmaker(bind=engine)
+
+        engine.dispose()
+
+    os.makedirs(config.data_dir, exist_ok=True)
+    if config.db_filename and os.path.dirname(config.db_filename):
+        os.makedirs(os.path.dirname(config.db_filename), exist_ok=True)
+    engine = create_db_engine(config)
+
+    try:
+        migrate(engine)
+    except OperationalError as err:
+        logging.error(
+            "Error opening database '%s': %s", display_url(config.database_url), err
+        )
+        sys.exit(1)
+
+    return sessionmaker(bind=engine)
+
+
+def current_monitors(ctx):
+    """Get the current monitors, cached for a while when served by the daemon"""
+    from screeninfo import get_monitors
 
-@click.group()
+    from .server import MONITORS_TTL
+
+    cache = ctx.obj.get("monitors_cache")
+    if cache is None:
+        return get_monitors()
+
+    if cache["expires"] < time.monotonic():
+        cache["monitors"] = get_monitors()
+        cache["expires"] = time.monotonic() + MONITORS_TTL
+
+    return cache["monitors"]
+
+
+class RedwallGroup(click.Group):
+    """Command group keeping track of the arguments of the invoked command"""
+
+    def resolve_command(self, ctx, args):
+        cmd_name, cmd, cmd_args = super().resolve_command(ctx, args)
+        ctx.meta["command_args"] = [cmd_name, *cmd_args]
+        return cmd_name, cmd, cmd_args
+
+
+@click.group(cls=RedwallGroup)
 @click.option(
     "-c", "--config-path", type=click.Path(exists=True), help="Configuration file"
 )
+@click.option(
+    "--local",
+    is_flag=True,
+    help="Run the command in this process, even if the daemon is running",
+)
 @click.help_option("-h", "--help")
 @click.version_option()
 @click.pass_context
-def redwall(ctx, config_path):
+def redwall(ctx, config_path, local: bool):
     """Redwall, the front wallpaper to your monitor(s)
 
     Redwall helps you manage a collection of curated wallpapers,
     courtesy of the Reddit community.
     """
+    if ctx.obj is not None and "db_session" in ctx.obj:
+        # the command is served by the daemon
+        return
+
     logging.getLogger().setLevel(logging.INFO)
     logging.basicConfig(format="%(asctime)s %(levelname)-7s %(message)s")
     logging.Formatter.converter = time.gmtime
@@ -43,20 +120,22 @@ def redwall(ctx, config_path):
         ]
     )
 
-    os.makedirs(config.data_dir, exist_ok=True)
-    engine = create_engine("sqlite:///%s" % config.db_filename)
+    if not local and os.path.exists(config.socket_path):
+        from .server import SERVED_COMMANDS, forward_request
 
-    try:
-        Base.metadata.create_all(engine)
-    except OperationalError as err:
-        logging.error("Error opening database '%s': %s", config.db_filename, err)
-        sys.exit(1)
+        if ctx.invoked_subcommand in SERVED_COMMANDS:
+            response = forward_request(config.socket_path, ctx.meta["command_args"])
 
-    db_session = sessionmaker(bind=engine)()
+            if response is not None:
+                output, status = response
+                sys.stdout.write(output)
+                ctx.exit(status)
 
     ctx.ensure_object(dict)
     ctx.obj["config"] = config
-    ctx.obj["db_session"] = db_session
+    ctx.obj["db_session"] = open_database(
+        config, read_only=ctx.invoked_subcommand in READ_ONLY_COMMANDS
+    )()
 
 
 @redwall.command()
@@ -69,7 +148,18 @@ def redwall(ctx, config_path):
 @click.pass_context
 def current(ctx, filename: bool):
     """Display information about the currently selected entry"""
-    entry = ctx.obj["db_session"].query(History).order_by(History.id.desc()).first()
+    from sqlalchemy.orm import joinedload
+
+    from .models import History, Submission
+
+    entry = (
+        ctx.obj["db_session"]
+        .query(History)
+        .options(joinedload(History.submission).joinedload(Submission.subreddit))
+        .filter(History.selected_on(ctx.obj["config"].host))
+        .order_by(History.id.desc())
+        .first()
+    )
 
     if not entry:
         print("Nothing found!")
@@ -81,23 +171,104 @@ def current(ctx, filename: bool):
 
 
 @redwall.command()
+@click.argument("filename")
+@click.pass_context
+def export(ctx, filename):
+    """Export the library to a JSON Lines file, or "-" for the standard output"""
+    from .transfer import export_library, open_library_file
+
+    with open_library_file(filename, "w") as f_library:
+        exported = export_library(ctx.obj["db_session"], f_library)
+
+    logging.info("Exported %d row(s)", exported)
+
+
+@redwall.command()
+@click.option(
+    "--incremental/--full",
+    default=None,
+    help="Skip submissions gathered by previous runs, or process all of them",
+)
+@click.option(
+    "--profile",
+    is_flag=True,
+    help="Profile the run with cProfile, see <data_dir>/gather.prof",
+)
 @click.pass_context
-def gather(ctx):
+def gather(ctx, incremental, profile):
     """Gather submission media from Reddit"""
-    gatherer = Gatherer(ctx.obj["config"], ctx.obj["db_session"])
-    gatherer.download_top_submissions()
+    from .gathering import Gatherer
+
+    config = ctx.obj["config"]
+    if incremental is not None:
+        config.incremental = incremental
+
+    gatherer = Gatherer(config, ctx.obj["db_session"])
+
+    if not profile:
+        gatherer.download_top_submissions()
+        return
+
+    import cProfile
+    import pstats
+
+    # only the calling thread is profiled; listings and downloads run in
+    # worker threads, and are timed by the run summary
+    profiler = cProfile.Profile()
+    profiler.runcall(gatherer.download_top_submissions)
+
+    profile_filename = os.path.join(config.data_dir, "gather.prof")
+    profiler.dump_stats(profile_filename)
+    logging.info("Profile saved to %s", profile_filename)
+
+    profile_stats = pstats.Stats(profiler, stream=sys.stderr)
+    profile_stats.sort_stats("cumulative").print_stats(PROFILE_LINES)
 
 
 @redwall.command()
 @click.pass_context
 def history(ctx):
     """Display the history of selected entries"""
-    entries = ctx.obj["db_session"].query(History).order_by(History.id.asc()).all()
+    from sqlalchemy.orm import contains_eager
+
+    from .models import History
+
+    entries = (
+        ctx.obj["db_session"]
+        .query(History)
+        .outerjoin(History.submission)
+        .options(contains_eager(History.submission))
+        .filter(History.selected_on(ctx.obj["config"].host))
+        .order_by(History.id.asc())
+        .yield_per(500)
+    )
 
     for entry in entries:
         print("%s | %s" % (entry.date, entry.submission.brief()))
 
 
+@redwall.command("import")
+@click.argument("filename")
+@click.pass_context
+def import_library(ctx, filename):
+    """Import a library from a JSON Lines file, or "-" for the standard input
+
+    The database must be empty.
+    """
+    from .transfer import TransferError
+    from .transfer import import_library as load_library
+    from .transfer import open_library_file
+
+    try:
+        with open_library_file(filename, "r") as f_library:
+            imported = load_library(ctx.obj["db_session"], f_library)
+    except TransferError as err:
+        logging.error("Cannot import '%s': %s", filename, err)
+        sys.exit(1)
+
+    logging.info("Imported %d row(s)", imported)
+
+
 @redwall.command()
 @click.option(
     "-f",
@@ -109,8 +280,16 @@ def history(ctx):
 @click.pass_context
 def info(ctx, post_id, filename: bool):
     """Display information about a given submission"""
+    from sqlalchemy.orm import joinedload
+
+    from .models import Submission
+
     submission = (
-        ctx.obj["db_session"].query(Submission).filter_by(post_id=post_id).one()
+        ctx.obj["db_session"]
+        .query(Submission)
+        .options(joinedload(Submission.subreddit))
+        .filter_by(post_id=post_id)
+        .one()
     )
 
     if not submission:
@@ -125,40 +304,254 @@ def info(ctx, post_id, filename: bool):
 @click.pass_context
 def list_candidates(ctx):
     """List submissions suitable for the current monitor setup"""
-    chooser = Chooser(ctx.obj["db_session"], get_monitors())
+    from .election import Chooser
+
+    config = ctx.obj["config"]
+    chooser = Chooser(
+        ctx.obj["db_session"],
+        current_monitors(ctx),
+        aspect_ratio_tolerance=config.aspect_ratio_tolerance,
+    )
     chooser.list_candidates_by_subreddit()
 
 
+def wallpaper_filenames(config, submission, monitors):
+    """Get the filenames of a submission, pre-rendered for the monitors if any
+
+    When monitors have different resolutions, the image is rendered for each
+    of them, and one filename is returned per monitor; a single filename is
+    returned otherwise, or if renderings are missing.
+    """
+    from .rendering import rendered_filename
+
+    sizes = [(monitor.width, monitor.height) for monitor in monitors]
+    if len(set(sizes)) == 1:
+        sizes = sizes[:1]
+
+    filenames = [
+        rendered_filename(config.data_dir, submission, width, height)
+        for width, height in sizes
+    ]
+
+    if all(os.path.exists(filename) for filename in filenames):
+        return filenames
+
+    return [submission.image_filename]
+
+
+def print_wallpaper(config, submission, monitors, original, background):
+    """Print the filenames of a wallpaper, prefixed by its background color"""
+    if original:
+        filenames = [submission.image_filename]
+    else:
+        filenames = wallpaper_filenames(config, submission, monitors)
+
+    for filename in filenames:
+        if background:
+            color = submission.background_color or DEFAULT_BACKGROUND_COLOR
+            print("%s %s" % (color, filename))
+        else:
+            print(filename)
+
+
 @redwall.command()
+@click.option(
+    "--per-monitor/--same",
+    default=None,
+    help="Choose a different image for each monitor (one line per monitor)",
+)
+@click.option(
+    "--original",
+    is_flag=True,
+    help="Print the filename of the original image, rather than pre-rendered",
+)
+@click.option(
+    "--background",
+    is_flag=True,
+    help="Print the background color of the image before its filename",
+)
 @click.pass_context
-def random(ctx):
-    """Select a random submission suitable for the current monitor setup"""
-    chooser = Chooser(ctx.obj["db_session"], get_monitors())
-    submission = chooser.get_random_candidate()
-    print(submission.image_filename)
+def random(ctx, per_monitor: bool, original: bool, background: bool):
+    """Select a random submission suitable for the current monitor setup
+
+    With monitors of different resolutions, a single image pre-rendered for
+    each of them is printed on one line per monitor.
+    """
+    from .election import Chooser
+
+    config = ctx.obj["config"]
+    if per_monitor is None:
+        per_monitor = config.per_monitor
+
+    monitors = current_monitors(ctx)
+    chooser = Chooser(
+        ctx.obj["db_session"],
+        monitors,
+        aspect_ratio_tolerance=config.aspect_ratio_tolerance,
+        history_window=config.history_window,
+        host=config.host,
+    )
+
+    if not per_monitor:
+        submission = chooser.get_random_candidate()
+
+        if not submission:
+            print("Nothing found!")
+        else:
+            print_wallpaper(config, submission, monitors, original, background)
+        return
+
+    submissions = chooser.get_random_candidates()
+
+    if not any(submissions):
+        print("Nothing found!")
+        return
+
+    for monitor, submission in zip(monitors, submissions):
+        if not submission:
+            print("")
+        else:
+            print_wallpaper(config, submission, [monitor], original, background)
+
+
+@redwall.command()
+@click.option("-j", "--jobs", type=int, default=None, help="Number of processes")
+@click.pass_context
+def render(ctx, jobs: int):
+    """Pre-render candidates for the resolution of each known monitor"""
+    from screeninfo import ScreenInfoError
+
+    from .election import Chooser
+    from .rendering import Renderer
+
+    config = ctx.obj["config"]
+    db_session = ctx.obj["db_session"]
+
+    # candidates are rendered for all known layouts, including the current one
+    try:
+        Chooser(
+            db_session,
+            current_monitors(ctx),
+            aspect_ratio_tolerance=config.aspect_ratio_tolerance,
+        ).get_layout()
+    except ScreenInfoError as err:
+        logging.warning("Cannot enumerate monitors: %s", err)
+
+    rendered = Renderer(config, db_session, workers=jobs).render()
+    logging.info("Rendered %d submission(s)", rendered)
 
 
 @redwall.command()
+@click.pass_context
+def reindex(ctx):
+    """Rebuild the full-text search index"""
+    from .search import has_search_index, rebuild_search_index
+
+    db_session = ctx.obj["db_session"]
+
+    if not has_search_index(db_session):
+        print("Full-text search is not available")
+        sys.exit(1)
+
+    rebuild_search_index(db_session.connection())
+    db_session.commit()
+
+
+@redwall.command()
+@click.option("-j", "--jobs", type=int, default=None, help="Number of processes")
+@click.pass_context
+def rescan(ctx, jobs: int):
+    """Reconcile gathered submissions with the files of the data directory"""
+    from .scanning import Scanner
+
+    counts = Scanner(ctx.obj["config"], ctx.obj["db_session"], workers=jobs).rescan()
+
+    for status in (
+        "unchanged",
+        "updated",
+        "moved",
+        "missing",
+        "untracked",
+        "collected",
+    ):
+        print("%-10s %d" % (status, counts[status]))
+
+
+@redwall.command()
+@click.option("-n", "--limit", type=int, default=None, help="Maximum number of results")
+@click.option("--offset", type=int, default=0, help="Number of results to skip")
 @click.argument("text", nargs=-1)
 @click.pass_context
-def search(ctx, text: str):
-    """Search for entries by title"""
-    submissions = (
-        ctx.obj["db_session"]
-        .query(Submission)
-        .filter(Submission.title.ilike("%{}%".format(" ".join(text))))
-        .order_by(Submission.id.asc())
-        .all()
-    )
+def search(ctx, text: str, limit: int, offset: int):
+    """Search for entries by title or author"""
+    from .search import search_submissions
 
-    for submission in submissions:
+    submissions = search_submissions(ctx.obj["db_session"], text)
+    submissions = submissions.offset(offset).limit(limit)
+
+    results = 0
+    for submission in submissions.yield_per(100):
         print(submission.brief())
+        results += 1
+
+    print("\n%d result(s) found" % results)
 
-    print("\n%d result(s) found" % len(submissions))
+
+@redwall.command()
+@click.option(
+    "--gather-interval",
+    type=float,
+    default=None,
+    help="Gather submissions every so many hours, 0 to disable",
+)
+@click.pass_context
+def serve(ctx, gather_interval: float):
+    """Serve commands from a long-running process"""
+    from sqlalchemy.orm import sessionmaker
+
+    from .server import Server
+
+    config = ctx.obj["config"]
+    if gather_interval is None:
+        gather_interval = config.gather_interval
+
+    db_session = ctx.obj["db_session"]
+    db_session.close()
+    server = Server(redwall, config, sessionmaker(bind=db_session.get_bind()))
+
+    if gather_interval > 0:
+        server.start_gathering(gather_interval * 3600)
+
+    logging.info("Serving commands on %s", config.socket_path)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 @redwall.command()
+@click.option("--json", "as_json", is_flag=True, help="Print statistics as JSON")
+@click.option(
+    "--summary/--no-summary",
+    default=None,
+    help="Read statistics from the incrementally updated summary table",
+)
 @click.pass_context
-def stats(ctx):
+def stats(ctx, as_json: bool, summary: bool):
     """Display statistics about gathered submissions"""
-    display_stats(ctx.obj["db_session"])
+    import json
+
+    from .stats import collect_stats, display_stats
+
+    if summary is None:
+        summary = ctx.obj["config"].stats_summary
+
+    report = collect_stats(ctx.obj["db_session"], summary=summary)
+
+    if as_json:
+        print(json.dumps(report, indent=2))
+    else:
+        display_stats(report)
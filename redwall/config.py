@@ -1,14 +1,73 @@
 """Configuration management"""
 # pylint: disable=too-many-instance-attributes,too-few-public-methods
+# pylint: disable=too-many-statements
 import logging
 import os
+import socket
 from configparser import ConfigParser
 
+DEFAULT_ASPECT_RATIO_TOLERANCE = 0.25
+DEFAULT_CONTENT_STORE = False
 DEFAULT_DATA_DIR = os.path.join(os.getcwd(), "data")
+DEFAULT_DB_BUSY_TIMEOUT = 10.0
+DEFAULT_DB_CACHE_MB = 64
+DEFAULT_DB_COMMIT = "subreddit"
+DEFAULT_DB_FLUSH_INTERVAL = 10.0
+DEFAULT_DB_FLUSH_SIZE = 500
+DEFAULT_DB_MMAP_MB = 256
+DEFAULT_DB_POOL_SIZE = 5
+DEFAULT_DOWNLOAD_BACKOFF = 1.0
+DEFAULT_DOWNLOAD_RETRIES = 3
+DEFAULT_DOWNLOAD_WORKERS = 8
+DEFAULT_GATHER_INTERVAL = 0
+DEFAULT_HISTORY_WINDOW = 20
+DEFAULT_INCREMENTAL = False
+DEFAULT_LISTING_WORKERS = 4
+DEFAULT_MAX_DOWNLOAD_MB = 100
+DEFAULT_MIN_IMAGE_HEIGHT = 0
+DEFAULT_MIN_IMAGE_WIDTH = 0
+DEFAULT_PER_HOST_CONNECTIONS = 4
+DEFAULT_PER_MONITOR = False
+DEFAULT_RENDER_WORKERS = 0
+DEFAULT_STATS_SUMMARY = False
 DEFAULT_SUBMISSION_LIMIT = 20
 DEFAULT_SUBREDDITS = ["EarthPorn", "NaturePics"]
 DEFAULT_TIME_FILTER = "month"
 
+LISTING_TYPES = ("controversial", "hot", "new", "rising", "top")
+TIME_FILTERED_LISTING_TYPES = ("controversial", "top")
+TIME_FILTERS = ("all", "day", "hour", "month", "week", "year")
+
+
+def parse_listings(value, time_filter):
+    """Parse listings, e.g. ``top:month top:all new``
+
+    Time-filtered listings use the given time filter when none is specified;
+    returns a list of ``(listing_type, time_filter)`` tuples, where
+    time_filter is None for listings that are not filtered by time.
+    """
+    listings = []
+
+    for listing in value.replace(",", " ").split():
+        listing_type, _, listing_time_filter = listing.partition(":")
+
+        if listing_type not in LISTING_TYPES:
+            logging.warning("Invalid listing '%s', ignoring it", listing)
+            continue
+
+        if listing_type not in TIME_FILTERED_LISTING_TYPES:
+            listing_time_filter = None
+        elif not listing_time_filter:
+            listing_time_filter = time_filter
+        elif listing_time_filter not in TIME_FILTERS:
+            logging.warning("Invalid listing '%s', ignoring it", listing)
+            continue
+
+        if (listing_type, listing_time_filter) not in listings:
+            listings.append((listing_type, listing_time_filter))
+
+    return listings
+
 
 class Config:
     """Configuration manager"""
@@ -48,4 +107,147 @@ class Config:
             self.subreddits = DEFAULT_SUBREDDITS
             self.time_filter = DEFAULT_TIME_FILTER
 
-        self.db_filename = os.path.join(self.data_dir, "redwall.db")
+        # listings each subreddit is browsed through, see listing.ListingEngine
+        self.listings = parse_listings(
+            config.get("redwall", "listings", fallback="top"), self.time_filter
+        )
+        if not self.listings:
+            self.listings = [("top", self.time_filter)]
+        self.listing_workers = config.getint(
+            "redwall", "listing_workers", fallback=DEFAULT_LISTING_WORKERS
+        )
+
+        self.download_workers = config.getint(
+            "redwall", "download_workers", fallback=DEFAULT_DOWNLOAD_WORKERS
+        )
+        self.per_host_connections = config.getint(
+            "redwall", "per_host_connections", fallback=DEFAULT_PER_HOST_CONNECTIONS
+        )
+
+        # maximum size of a downloaded image, 0 disables the limit
+        self.max_download_size = config.getint(
+            "redwall", "max_download_mb", fallback=DEFAULT_MAX_DOWNLOAD_MB
+        )
+        self.max_download_size *= 1024 * 1024
+
+        # images smaller than this are not downloaded, 0 disables the limit
+        self.min_image_width = config.getint(
+            "redwall", "min_image_width", fallback=DEFAULT_MIN_IMAGE_WIDTH
+        )
+        self.min_image_height = config.getint(
+            "redwall", "min_image_height", fallback=DEFAULT_MIN_IMAGE_HEIGHT
+        )
+
+        self.download_retries = config.getint(
+            "redwall", "download_retries", fallback=DEFAULT_DOWNLOAD_RETRIES
+        )
+        self.download_backoff = config.getfloat(
+            "redwall", "download_backoff", fallback=DEFAULT_DOWNLOAD_BACKOFF
+        )
+
+        # only process submissions that were not gathered by a previous run
+        self.incremental = config.getboolean(
+            "redwall", "incremental", fallback=DEFAULT_INCREMENTAL
+        )
+
+        # store identical images only once, see storage.BlobStore
+        self.content_store = config.getboolean(
+            "redwall", "content_store", fallback=DEFAULT_CONTENT_STORE
+        )
+
+        # batched database writes
+        self.db_flush_size = config.getint(
+            "redwall", "db_flush_size", fallback=DEFAULT_DB_FLUSH_SIZE
+        )
+        self.db_flush_interval = config.getfloat(
+            "redwall", "db_flush_interval", fallback=DEFAULT_DB_FLUSH_INTERVAL
+        )
+
+        # commit once per "subreddit", or once per gathering "run"
+        self.db_commit = config.get("redwall", "db_commit", fallback=DEFAULT_DB_COMMIT)
+        if self.db_commit not in ("run", "subreddit"):
+            logging.warning(
+                "Invalid db_commit value '%s', using '%s'",
+                self.db_commit,
+                DEFAULT_DB_COMMIT,
+            )
+            self.db_commit = DEFAULT_DB_COMMIT
+
+        # SQLite tuning, see db.create_db_engine
+        self.db_busy_timeout = config.getfloat(
+            "redwall", "db_busy_timeout", fallback=DEFAULT_DB_BUSY_TIMEOUT
+        )
+        self.db_cache_mb = config.getint(
+            "redwall", "db_cache_mb", fallback=DEFAULT_DB_CACHE_MB
+        )
+        self.db_mmap_mb = config.getint(
+            "redwall", "db_mmap_mb", fallback=DEFAULT_DB_MMAP_MB
+        )
+
+        # choose a different image for each monitor
+        self.per_monitor = config.getboolean(
+            "redwall", "per_monitor", fallback=DEFAULT_PER_MONITOR
+        )
+
+        # relative difference allowed between the aspect ratios of an image and
+        # of the monitor it is displayed on
+        self.aspect_ratio_tolerance = config.getfloat(
+            "redwall", "aspect_ratio_tolerance", fallback=DEFAULT_ASPECT_RATIO_TOLERANCE
+        )
+
+        # number of recent selections that are not chosen again
+        self.history_window = config.getint(
+            "redwall", "history_window", fallback=DEFAULT_HISTORY_WINDOW
+        )
+
+        # name selections are recorded under, so that hosts sharing the same
+        # database each keep their own history
+        self.host = config.get("redwall", "host", fallback=socket.gethostname())
+
+        # processes rendering images, 0 to use all cores
+        self.render_workers = config.getint(
+            "redwall", "render_workers", fallback=DEFAULT_RENDER_WORKERS
+        )
+
+        # gathering run summary, as JSON and for the Prometheus node exporter
+        self.gather_summary = config.get(
+            "redwall",
+            "gather_summary",
+            fallback=os.path.join(self.data_dir, "gather-summary.json"),
+        )
+        self.prometheus_textfile = config.get(
+            "redwall", "prometheus_textfile", fallback=""
+        )
+
+        # read statistics from an incrementally updated summary table
+        self.stats_summary = config.getboolean(
+            "redwall", "stats_summary", fallback=DEFAULT_STATS_SUMMARY
+        )
+
+        # SQLAlchemy database URL, e.g. postgresql://redwall@db.lan/redwall,
+        # see db.create_db_engine; db_filename is None unless it is SQLite
+        self.database_url = config.get(
+            "redwall",
+            "database_url",
+            raw=True,
+            fallback="sqlite:///%s" % os.path.join(self.data_dir, "redwall.db"),
+        )
+        self.db_filename = None
+
+        scheme, _, path = self.database_url.partition(":///")
+        if scheme.split("+")[0] == "sqlite":
+            self.db_filename = path
+
+        self.db_pool_size = config.getint(
+            "redwall", "db_pool_size", fallback=DEFAULT_DB_POOL_SIZE
+        )
+
+        # daemon, see server.Server
+        self.socket_path = config.get(
+            "redwall",
+            "socket_path",
+            fallback=os.path.join(self.data_dir, "redwall.sock"),
+        )
+        self.gather_interval = config.getfloat(
+            "redwall", "gather_interval", fallback=DEFAULT_GATHER_INTERVAL
+        )
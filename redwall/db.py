@@ -0,0 +1,86 @@
+"""Database engine factory
+
+The library is stored in SQLite by default, or in the database given by the
+``database_url`` setting, e.g. a PostgreSQL database shared by several hosts.
+
+SQLite connections are tuned as they are opened:
+
+- the write-ahead log lets readers, e.g. ``redwall random`` run from a timer,
+  proceed while the gatherer is writing, and ``synchronous=NORMAL`` only syncs
+  the log at checkpoints, which is safe in WAL mode;
+- the database file is memory-mapped, and the page cache enlarged;
+- writers wait for the lock to be released for a while, rather than failing
+  right away with "database is locked".
+
+Commands that only run queries may open the database read-only, so that they
+never take a write lock, nor create or upgrade the database.
+"""
+from urllib.parse import quote
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+def set_sqlite_pragmas(dbapi_connection, config, read_only):
+    """Tune a new SQLite connection"""
+    cursor = dbapi_connection.cursor()
+
+    # the journal mode is persistent, and cannot be changed read-only
+    if not read_only:
+        cursor.execute("PRAGMA journal_mode=WAL")
+
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=%d" % (config.db_busy_timeout * 1000))
+    cursor.execute("PRAGMA cache_size=%d" % -(config.db_cache_mb * 1024))
+    cursor.execute("PRAGMA mmap_size=%d" % (config.db_mmap_mb * 1024 * 1024))
+    cursor.close()
+
+
+def create_sqlite_engine(config, read_only):
+    """Create a tuned engine for a SQLite database"""
+    if read_only:
+        url = "sqlite:///file:%s?mode=ro&uri=true" % quote(config.db_filename)
+    else:
+        url = "sqlite:///%s" % config.db_filename
+
+    engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        connect_args={"check_same_thread": False},
+    )
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, _):
+        set_sqlite_pragmas(dbapi_connection, config, read_only)
+
+    return engine
+
+
+def create_db_engine(config, read_only=False):
+    """Create an engine for the configured database
+
+    Connections are pooled and may be used by several threads in turn, e.g.
+    by the daemon and its gathering thread, so that SQLite's page cache and
+    memory map, or server connections, are kept between requests.
+    """
+    if config.db_filename is not None:
+        return create_sqlite_engine(config, read_only)
+
+    connect_args = {}
+    if read_only and make_url(config.database_url).get_backend_name() == "postgresql":
+        # a server default for the whole session: unlike SET SESSION
+        # CHARACTERISTICS, it is not undone when a transaction is rolled back
+        connect_args["options"] = "-c default_transaction_read_only=on"
+
+    return create_engine(
+        config.database_url,
+        pool_size=config.db_pool_size,
+        pool_pre_ping=True,
+        connect_args=connect_args,
+    )
+
+
+def display_url(database_url):
+    """Get a database URL that can be logged, without its password"""
+    return repr(make_url(database_url))
@@ -0,0 +1,362 @@
+"""Download images over a shared, pooled HTTP session"""
+# pylint: disable=too-few-public-methods,too-many-instance-attributes
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import suppress
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    ChunkedEncodingError,
+)
+from requests.exceptions import ConnectionError as RequestsConnectionError
+from requests.exceptions import (
+    ContentDecodingError,
+    HTTPError,
+    RequestException,
+    Timeout,
+    TooManyRedirects,
+)
+
+from .metrics import RunMetrics
+from .probing import PROBE_MAX_BYTES, probe_image_bytes
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_TIMEOUT = 30
+
+IMGUR_HOSTS = ("imgur.com", "i.imgur.com", "m.imgur.com")
+IMGUR_THUMBNAIL_SUFFIXES = "sbtmlh"
+REDDIT_IMAGE_HOST = "i.redd.it"
+REDDIT_PREVIEW_HOST = "preview.redd.it"
+REDDIT_PREVIEW_VARIANT_PARAMS = ("auto", "crop", "format", "height", "width")
+
+RETRY_MAX_DELAY = 300
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+HEADERS = {
+    "Accept-Encoding": "gzip, deflate, sdch",
+    "Accept-Language": "en-US,en;q=0.8",
+    "Upgrade-Insecure-Requests": "1",
+    "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
+    + " (KHTML, like Gecko) Chrome/56.0.2924.87"
+    + " Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,"
+    + "image/webp,*/*;q=0.8",
+    "Cache-Control": "max-age=0",
+    "Connection": "keep-alive",
+}
+
+
+class DownloadTooLarge(RequestException):
+    """The downloaded body exceeds the configured maximum size"""
+
+
+class ImageTooSmall(RequestException):
+    """The image being downloaded is smaller than the configured minimum size"""
+
+    def __init__(self, message, width, height):
+        """Keep track of the actual image dimensions"""
+        super().__init__(message)
+        self.width = width
+        self.height = height
+
+
+class HostLimiter:
+    """Bound the number of concurrent connections to a given host"""
+
+    def __init__(self, max_connections):
+        """Prepare per-host semaphores"""
+        self.max_connections = max_connections
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def __call__(self, url):
+        """Get the semaphore guarding the host of the given URL"""
+        host = urlparse(url).hostname
+
+        with self.lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = threading.BoundedSemaphore(self.max_connections)
+            return self.semaphores[host]
+
+
+class Downloader:
+    """HTTP client shared by all downloads of a gathering run
+
+    Connections are kept alive and pooled per host, and transient failures
+    (connection errors, interrupted bodies, timeouts, 429 and 5xx responses)
+    are retried with an exponential backoff, honouring the server's
+    ``Retry-After`` header; interrupted bodies are resumed where they stopped.
+    """
+
+    def __init__(self, config, metrics=None):
+        """Prepare the HTTP session and its connection pools"""
+        self.metrics = metrics or RunMetrics()
+        self.host_limiter = HostLimiter(config.per_host_connections)
+        self.max_download_size = config.max_download_size
+        self.min_image_width = config.min_image_width
+        self.min_image_height = config.min_image_height
+        self.retries = config.download_retries
+        self.backoff = config.download_backoff
+
+        adapter = HTTPAdapter(
+            pool_connections=config.download_workers,
+            pool_maxsize=config.per_host_connections,
+        )
+
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close pooled connections"""
+        self.session.close()
+
+    def download(self, url, filename):
+        """Download a remote file, retrying on transient errors
+
+        The time spent and the bytes received are recorded by host, including
+        failed attempts, but excluding the time spent waiting for a
+        connection slot or before retrying.
+        """
+        host = urlparse(url).hostname
+        attempt = 0
+
+        while True:
+            try:
+                with self.host_limiter(url):
+                    start = time.monotonic()
+                    try:
+                        size = self.download_once(url, filename)
+                    except RequestException:
+                        self.metrics.add_download(
+                            host, 0, time.monotonic() - start, failed=True
+                        )
+                        raise
+                    self.metrics.add_download(host, size, time.monotonic() - start)
+                return
+
+            except HTTPError as err:
+                if err.response.status_code not in RETRY_STATUSES:
+                    logging.error(err)
+                    raise
+                if attempt >= self.retries:
+                    logging.error(err)
+                    raise
+                delay = self.retry_delay(attempt, err.response)
+
+            except (
+                ChunkedEncodingError,
+                ContentDecodingError,
+                RequestsConnectionError,
+                Timeout,
+            ) as err:
+                if attempt >= self.retries:
+                    logging.error(err)
+                    raise
+                delay = self.retry_delay(attempt)
+
+            except ImageTooSmall as err:
+                logging.info(err)
+                raise
+
+            except (DownloadTooLarge, TooManyRedirects) as err:
+                logging.error(err)
+                raise
+
+            attempt += 1
+            logging.warning(
+                "Retrying %s in %.1fs (attempt %d/%d)",
+                url,
+                delay,
+                attempt,
+                self.retries,
+            )
+            time.sleep(delay)
+
+    def retry_delay(self, attempt, response=None):
+        """Compute the delay before the next attempt
+
+        The server's ``Retry-After`` header takes precedence; otherwise the
+        delay grows exponentially, with full jitter to spread retries.
+        """
+        if response is not None:
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if retry_after is not None:
+                return min(retry_after, RETRY_MAX_DELAY)
+
+        return random.uniform(0, min(self.backoff * 2**attempt, RETRY_MAX_DELAY))
+
+    def download_once(self, url, filename):
+        """Download a remote file
+
+        The response body is streamed to a temporary ``.part`` file that is
+        renamed once the download is complete, so an interrupted download never
+        leaves a truncated file behind; the next attempt resumes from the
+        partial file using an HTTP Range request.
+
+        Returns the number of bytes received.
+        """
+        logging.info("Downloading %s", url)
+
+        part_filename = filename + ".part"
+        headers = {}
+
+        try:
+            offset = os.path.getsize(part_filename)
+        except FileNotFoundError:
+            offset = 0
+
+        if offset:
+            # byte ranges apply to the encoded body, ask for the raw image
+            headers["Accept-Encoding"] = "identity"
+            headers["Range"] = "bytes=%d-" % offset
+
+        try:
+            with self.session.get(
+                url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+            ) as response:
+                if response.status_code == 416:
+                    # the partial file does not match the remote resource anymore
+                    os.remove(part_filename)
+                    return self.download_once(url, filename)
+
+                response.raise_for_status()
+
+                if response.status_code != 206:
+                    offset = 0
+
+                size = self.write_body(response, part_filename, offset)
+
+            os.replace(part_filename, filename)
+
+        except (DownloadTooLarge, ImageTooSmall):
+            with suppress(FileNotFoundError):
+                os.remove(part_filename)
+            raise
+
+        return size
+
+    def write_body(self, response, part_filename, offset):
+        """Stream a response body to a file, enforcing size constraints
+
+        Unless the download is resumed, the image dimensions are probed from
+        the first chunks of the body, so that images smaller than the
+        configured minimum are rejected before being fully downloaded.
+
+        Returns the number of bytes received.
+        """
+        max_size = self.max_download_size
+        content_length = int(response.headers.get("Content-Length", 0))
+
+        if max_size and offset + content_length > max_size:
+            raise DownloadTooLarge(
+                "%s is too large: %d bytes" % (response.url, content_length)
+            )
+
+        probing = offset == 0 and (self.min_image_width or self.min_image_height)
+        header = b""
+
+        size = offset
+        with open(part_filename, "ab" if offset else "wb") as f_part:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                size += len(chunk)
+                if max_size and size > max_size:
+                    raise DownloadTooLarge(
+                        "%s is too large: more than %d bytes" % (response.url, max_size)
+                    )
+
+                if probing:
+                    header += chunk
+                    probing = self.check_dimensions(response.url, header)
+
+                f_part.write(chunk)
+
+        return size - offset
+
+    def check_dimensions(self, url, header):
+        """Check the dimensions of an image from its first bytes
+
+        Returns whether more bytes are needed to read the dimensions.
+        """
+        dimensions = probe_image_bytes(header)
+
+        if dimensions is None:
+            return len(header) < PROBE_MAX_BYTES
+
+        width, height = dimensions
+        if width < self.min_image_width or height < self.min_image_height:
+            raise ImageTooSmall(
+                "%s is too small: %d x %d" % (url, width, height), width, height
+            )
+
+        return False
+
+
+def parse_retry_after(value):
+    """Parse a Retry-After header value into a number of seconds"""
+    if not value:
+        return None
+
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_image_url(url):
+    """Normalize an image URL, so that variants of the same URL are equal
+
+    The scheme and fragment are ignored; Imgur and Reddit image URLs are
+    reduced to the identifier of the image, regardless of the subdomain,
+    extension, thumbnail suffix or query string. Reddit previews that are
+    resized or re-encoded are kept apart from the original image, and the
+    query string of other URLs is kept, as it may identify the image.
+    """
+    parsed_url = urlparse(url)
+    host = (parsed_url.hostname or "").lower()
+    path = parsed_url.path.rstrip("/")
+
+    if host.startswith("www."):
+        host = host[4:]
+
+    if host in IMGUR_HOSTS and "/" not in path.strip("/"):
+        image_id = os.path.splitext(path.strip("/"))[0]
+        if len(image_id) in (6, 8) and image_id[-1] in IMGUR_THUMBNAIL_SUFFIXES:
+            image_id = image_id[:-1]
+        return "i.imgur.com/" + image_id
+
+    if host in (REDDIT_IMAGE_HOST, REDDIT_PREVIEW_HOST):
+        image_id = os.path.splitext(os.path.basename(path))[0]
+        variant_params = sorted(
+            (name, value)
+            for name, value in parse_qsl(parsed_url.query)
+            if name in REDDIT_PREVIEW_VARIANT_PARAMS
+        )
+        if host == REDDIT_PREVIEW_HOST and variant_params:
+            return (
+                REDDIT_PREVIEW_HOST + "/" + image_id + "?" + urlencode(variant_params)
+            )
+        return REDDIT_IMAGE_HOST + "/" + image_id
+
+    if parsed_url.query:
+        return host + path + "?" + parsed_url.query
+
+    return host + path
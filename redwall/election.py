@@ -1,73 +1,529 @@
-"""Find images to set as wallpapers for the current monitor configuration"""
+"""Find images to set as wallpapers for the current monitor configuration
+
+Suitable submissions are materialized in the candidates table for each
+monitor layout; candidates are added incrementally, as new submissions are
+gathered, and only recomputed when the aspect ratio tolerance changes.
+"""
+# pylint: disable=too-many-instance-attributes
+import math
 import random
+import re
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.exc import IntegrityError
+
+from .config import DEFAULT_ASPECT_RATIO_TOLERANCE, DEFAULT_HISTORY_WINDOW
+from .hashing import dhash_band, hamming_distance
+from .models import (
+    DHASH_BANDS,
+    Candidate,
+    History,
+    Layout,
+    Submission,
+    Subreddit,
+    dhash_band_expression,
+)
+
+# maximum Hamming distance between the dHashes of similar images; sharing a
+# dHash band is guaranteed for distances up to 3, see models.DHASH_BANDS
+SIMILAR_DISTANCE = 3
+
+# the weight of a candidate grows with its score, and doubles for every year
+# between a fixed origin and its creation, so that weights never need to be
+# recomputed as time goes by
+RECENCY_ORIGIN = datetime(2005, 6, 23)
+RECENCY_HALF_LIFE = timedelta(days=365)
+
+# subreddits whose remaining weight is below this fraction of their total
+# weight only have excluded candidates left
+EXCLUDED_WEIGHT_EPSILON = 1e-9
+
+Monitor = namedtuple("Monitor", ["width", "height", "x", "y"])
+
+
+def layout_signature(monitors):
+    """Identify a monitor layout by the geometry of each monitor"""
+    return ",".join(
+        "%dx%d%+d%+d"
+        % (
+            monitor.width,
+            monitor.height,
+            getattr(monitor, "x", 0),
+            getattr(monitor, "y", 0),
+        )
+        for monitor in monitors
+    )
+
+
+def parse_layout_signature(signature):
+    """Get the monitors of a layout from its signature"""
+    return [
+        Monitor(*(int(value) for value in geometry))
+        for geometry in re.findall(r"(\d+)x(\d+)([+-]\d+)([+-]\d+)", signature)
+    ]
+
+
+def reset_layout_candidates(db_session):
+    """Discard the candidates of all monitor layouts
+
+    Candidates are only ever appended; when the images of existing submissions
+    change, they are rebuilt on the next election.
+    """
+    db_session.query(Candidate).delete()
+    db_session.query(Layout).update({Layout.max_submission_id: 0})
+
 
-from sqlalchemy import func
-from sqlalchemy.orm.exc import NoResultFound
+def submission_weight(score, created_utc):
+    """Compute the selection weight of a submission"""
+    weight = math.log2(2 + max(score or 0, 0))
 
-from .models import History, Submission, Subreddit
+    if created_utc is not None:
+        weight *= 2 ** ((created_utc - RECENCY_ORIGIN) / RECENCY_HALF_LIFE)
+
+    return weight
+
+
+def update_layout_candidates(db_session):
+    """Add new submissions to the candidates of all known monitor layouts"""
+    for layout in db_session.query(Layout).all():
+        chooser = Chooser(
+            db_session,
+            parse_layout_signature(layout.signature),
+            aspect_ratio_tolerance=layout.aspect_ratio_tolerance,
+        )
+        chooser.update_candidates(layout)
+
+    db_session.commit()
 
 
 class Chooser:
     """Choose submissions suitable for wallpaper usage"""
 
-    def __init__(self, db_session, monitors):
+    def __init__(
+        self,
+        db_session,
+        monitors,
+        aspect_ratio_tolerance=DEFAULT_ASPECT_RATIO_TOLERANCE,
+        history_window=DEFAULT_HISTORY_WINDOW,
+        host=None,
+    ):
         """Load configuration and prepare resources"""
         self.db_session = db_session
+        self.monitors = list(monitors)
+        self.aspect_ratio_tolerance = aspect_ratio_tolerance
+        self.history_window = history_window
+        self.host = host
+        self.signature = layout_signature(self.monitors)
 
         # when choosing the same image for all monitors, it should be:
         # - wider than the widest monitor
         # - taller than the tallest monitor
-        self.image_height = max([m.height for m in monitors])
-        self.image_width = max([m.width for m in monitors])
+        self.image_height = max(m.height for m in self.monitors)
+        self.image_width = max(m.width for m in self.monitors)
+
+    def query_candidates(self):
+        """Query suitable submissions for the current monitor setup"""
+        return self.db_session.query(Submission).filter(
+            Submission.image_downloaded.is_(True),
+            Submission.image_height_px >= self.image_height,
+            Submission.image_width_px >= self.image_width,
+        )
 
     def get_candidates(self):
         """Get suitable submissions for the current monitor setup"""
+        layout = self.get_layout()
+
         return (
             self.db_session.query(Submission)
+            .join(Candidate, Candidate.submission_id == Submission.id)
             .filter(
-                Submission.image_height_px >= self.image_height,
-                Submission.image_width_px >= self.image_width,
+                Candidate.layout_id == layout.id,
+                Candidate.monitor == Candidate.ALL_MONITORS,
             )
+            .order_by(Candidate.position)
             .all()
         )
 
-    def get_random_candidate(self):
-        """Choose a random submission among suitable candidates"""
-        submissions = self.get_candidates()
-        submission = random.choice(submissions)
+    def query_monitor_candidates(self, monitor):
+        """Query submissions suitable for a single monitor
+
+        Images must be at least as large as the monitor, and have a similar
+        aspect ratio, hence the same orientation.
+        """
+        ratio = monitor.width / monitor.height
+
+        return self.db_session.query(Submission).filter(
+            Submission.image_downloaded.is_(True),
+            Submission.image_height_px >= monitor.height,
+            Submission.image_width_px >= monitor.width,
+            Submission.image_width_px
+            >= Submission.image_height_px * ratio * (1 - self.aspect_ratio_tolerance),
+            Submission.image_width_px
+            <= Submission.image_height_px * ratio * (1 + self.aspect_ratio_tolerance),
+        )
+
+    def get_layout(self):
+        """Get the current monitor layout, with up-to-date candidates"""
+        layout = (
+            self.db_session.query(Layout)
+            .filter_by(signature=self.signature)
+            .one_or_none()
+        )
+
+        if layout is None:
+            layout = self.create_layout()
+
+        if layout.aspect_ratio_tolerance != self.aspect_ratio_tolerance:
+            self.lock_layout(layout)
+
+        if layout.aspect_ratio_tolerance != self.aspect_ratio_tolerance:
+            self.db_session.query(Candidate).filter_by(layout_id=layout.id).delete()
+            layout.aspect_ratio_tolerance = self.aspect_ratio_tolerance
+            layout.max_submission_id = 0
+
+        self.update_candidates(layout)
+        self.db_session.commit()
+
+        return layout
+
+    def create_layout(self):
+        """Create the current monitor layout
+
+        If another process created it in the meantime, theirs is returned.
+        """
+        layout = Layout(
+            signature=self.signature,
+            aspect_ratio_tolerance=self.aspect_ratio_tolerance,
+            max_submission_id=0,
+        )
+        self.db_session.add(layout)
 
         try:
-            historow = (
-                self.db_session.query(History)
-                .filter_by(submission_id=submission.id)
-                .one()
-            )
-        except NoResultFound:
-            historow = History(submission_id=submission.id)
-            self.db_session.add(historow)
             self.db_session.commit()
+        except IntegrityError:
+            self.db_session.rollback()
+            layout = (
+                self.db_session.query(Layout).filter_by(signature=self.signature).one()
+            )
+
+        return layout
+
+    def lock_layout(self, layout):
+        """Lock a layout until the end of the transaction, and reload it
+
+        Candidates may be updated concurrently, e.g. by several hosts sharing
+        the same database, or by the daemon and its gathering thread: updates
+        are serialized, so that the last one sees the candidates appended by
+        the others.
+
+        The layout row is locked with SELECT ... FOR UPDATE; SQLite ignores it,
+        and the layout is written to instead, which takes the database lock.
+        """
+        if self.db_session.get_bind().dialect.name == "sqlite":
+            self.db_session.query(Layout).filter_by(id=layout.id).update(
+                {Layout.max_submission_id: Layout.max_submission_id},
+                synchronize_session=False,
+            )
+
+        self.db_session.query(Layout).filter_by(
+            id=layout.id
+        ).with_for_update().populate_existing().one()
+
+    def update_candidates(self, layout):
+        """Add the submissions gathered since the last update to candidates
+
+        Candidates are appended to each set, and their cumulative weights
+        carried on from the last candidate of the same subreddit; returns False
+        if there are no new submissions.
+        """
+        max_submission_id = self.db_session.query(func.max(Submission.id)).scalar() or 0
+        if max_submission_id <= layout.max_submission_id:
+            return False
+
+        # another process may have appended the same submissions meanwhile
+        self.lock_layout(layout)
+        if max_submission_id <= layout.max_submission_id:
+            return False
+
+        candidate_sets = [(Candidate.ALL_MONITORS, self.query_candidates())]
+        candidate_sets.extend(
+            (index, self.query_monitor_candidates(monitor))
+            for index, monitor in enumerate(self.monitors)
+        )
+
+        for monitor, candidates in candidate_sets:
+            position = self.count_candidates(layout.id, monitor)
+            cumulative_weights = self.get_subreddit_weights(layout.id, monitor)
+            rows = []
+
+            new_candidates = (
+                candidates.filter(
+                    Submission.id > layout.max_submission_id,
+                    Submission.id <= max_submission_id,
+                )
+                .with_entities(
+                    Submission.id,
+                    Submission.subreddit_id,
+                    Submission.score,
+                    Submission.created_utc,
+                )
+                .order_by(Submission.id)
+                .all()
+            )
+
+            for submission_id, subreddit_id, score, created in new_candidates:
+                weight = submission_weight(score, created)
+                cumulative_weights[subreddit_id] = (
+                    cumulative_weights.get(subreddit_id, 0.0) + weight
+                )
+                rows.append(
+                    {
+                        "layout_id": layout.id,
+                        "monitor": monitor,
+                        "position": position,
+                        "submission_id": submission_id,
+                        "subreddit_id": subreddit_id,
+                        "weight": weight,
+                        "cumulative_weight": cumulative_weights[subreddit_id],
+                    }
+                )
+                position += 1
+
+            self.db_session.bulk_insert_mappings(Candidate, rows)
+
+        layout.max_submission_id = max_submission_id
+        return True
+
+    def count_candidates(self, layout_id, monitor):
+        """Count the candidates of a layout for a given monitor"""
+        last_position = (
+            self.db_session.query(func.max(Candidate.position))
+            .filter(Candidate.layout_id == layout_id, Candidate.monitor == monitor)
+            .scalar()
+        )
+
+        return 0 if last_position is None else last_position + 1
+
+    def get_subreddit_weights(self, layout_id, monitor):
+        """Get the total weight of the candidates of each subreddit
+
+        Each total is looked up on the weight index.
+        """
+        total_weight = (
+            select(func.max(Candidate.cumulative_weight))
+            .where(
+                Candidate.layout_id == layout_id,
+                Candidate.monitor == monitor,
+                Candidate.subreddit_id == Subreddit.id,
+            )
+            .scalar_subquery()
+        )
+
+        return {
+            subreddit_id: weight
+            for subreddit_id, weight in self.db_session.query(
+                Subreddit.id, total_weight
+            )
+            if weight is not None
+        }
+
+    def get_random_submission(self, layout_id, monitor, excluded_ids):
+        """Choose a weighted random candidate for a given monitor
+
+        A subreddit is chosen first, so that subreddits with many candidates do
+        not crowd out the others; a candidate is then chosen in proportion to
+        its weight, by looking up a random cumulative weight.
+
+        Excluded submissions are skipped by removing their weight from the
+        draw, unless there are no other candidates; returns None if there are
+        no candidates.
+        """
+        subreddit_weights = self.get_subreddit_weights(layout_id, monitor)
+
+        if not subreddit_weights:
+            return None
+
+        # (start, weight) of the excluded candidates of each subreddit
+        excluded = defaultdict(list)
+        if excluded_ids:
+            rows = (
+                self.db_session.query(
+                    Candidate.subreddit_id,
+                    Candidate.cumulative_weight,
+                    Candidate.weight,
+                )
+                .filter(
+                    Candidate.layout_id == layout_id,
+                    Candidate.monitor == monitor,
+                    Candidate.submission_id.in_(excluded_ids),
+                )
+                .order_by(Candidate.cumulative_weight)
+            )
+            for subreddit_id, cumulative_weight, weight in rows:
+                excluded[subreddit_id].append((cumulative_weight - weight, weight))
+
+        available_weights = {
+            subreddit_id: total - sum(weight for _, weight in excluded[subreddit_id])
+            for subreddit_id, total in subreddit_weights.items()
+        }
+        eligible = [
+            subreddit_id
+            for subreddit_id, weight in available_weights.items()
+            if weight > subreddit_weights[subreddit_id] * EXCLUDED_WEIGHT_EPSILON
+        ]
+
+        if not eligible:
+            excluded.clear()
+            available_weights = subreddit_weights
+            eligible = list(subreddit_weights)
+
+        subreddit_id = random.choice(eligible)
+        target = random.uniform(0, available_weights[subreddit_id])
+
+        for start, weight in excluded[subreddit_id]:
+            if start > target:
+                break
+            target += weight
+
+        candidates = (
+            self.db_session.query(Submission)
+            .join(Candidate, Candidate.submission_id == Submission.id)
+            .filter(
+                Candidate.layout_id == layout_id,
+                Candidate.monitor == monitor,
+                Candidate.subreddit_id == subreddit_id,
+            )
+        )
+
+        # rounding errors may leave the target past the last candidate
+        return (
+            candidates.filter(Candidate.cumulative_weight > target)
+            .order_by(Candidate.cumulative_weight)
+            .first()
+            or candidates.order_by(Candidate.cumulative_weight.desc()).first()
+        )
+
+    def get_recent_selections(self):
+        """Get the IDs and dHashes of recently selected submissions, latest first"""
+        query = self.db_session.query(
+            History.submission_id, Submission.image_dhash
+        ).join(Submission, History.submission_id == Submission.id)
+
+        if self.host is not None:
+            query = query.filter(History.selected_on(self.host))
+
+        return query.order_by(History.id.desc()).limit(self.history_window).all()
+
+    def get_similar_submission_ids(self, dhash):
+        """Find submissions whose image looks like the one with the given dHash
+
+        Submissions sharing at least one dHash band are looked up on the band
+        indexes, then compared with their full dHash.
+        """
+        rows = self.db_session.query(Submission.id, Submission.image_dhash).filter(
+            or_(
+                *(
+                    dhash_band_expression(Submission.image_dhash, band)
+                    == dhash_band(dhash, band)
+                    for band in range(DHASH_BANDS)
+                )
+            )
+        )
+
+        return [
+            submission_id
+            for submission_id, other_dhash in rows
+            if hamming_distance(dhash, other_dhash) <= SIMILAR_DISTANCE
+        ]
+
+    def get_random_candidate(self):
+        """Choose a weighted random submission among suitable candidates
+
+        Recently selected candidates, and candidates that look like the current
+        wallpaper, are excluded, unless there are no other candidates.
+        """
+        layout = self.get_layout()
+        recent = self.get_recent_selections()
+        excluded_ids = [submission_id for submission_id, _ in recent]
+
+        if recent and recent[0][1] is not None:
+            excluded_ids.extend(self.get_similar_submission_ids(recent[0][1]))
+
+        submission = self.get_random_submission(
+            layout.id, Candidate.ALL_MONITORS, excluded_ids
+        )
+
+        if submission is not None:
+            self.record_selection(submission)
 
         return submission
 
+    def get_random_candidates(self):
+        """Choose a different weighted random submission for each monitor
+
+        Recently selected candidates are excluded, unless there are no other
+        candidates.
+
+        Returns a list of submissions, in monitor order; an entry is None if
+        there is no suitable submission for the corresponding monitor.
+        """
+        layout = self.get_layout()
+        excluded_ids = [
+            submission_id for submission_id, _ in self.get_recent_selections()
+        ]
+        submissions = []
+
+        for monitor in range(len(self.monitors)):
+            submission = self.get_random_submission(layout.id, monitor, excluded_ids)
+            submissions.append(submission)
+
+            if submission is not None:
+                excluded_ids.append(submission.id)
+
+        for submission in submissions:
+            if submission is not None:
+                self.record_selection(submission)
+
+        return submissions
+
+    def record_selection(self, submission):
+        """Append a selected submission to the history"""
+        self.db_session.add(History(submission_id=submission.id, host=self.host))
+        self.db_session.commit()
+
     def list_candidates_by_subreddit(self):
-        """Pretty-print suitable submissions"""
-        subreddits = (
-            self.db_session.query(Subreddit).order_by(func.lower(Subreddit.name)).all()
+        """Pretty-print suitable submissions
+
+        Subreddits and their candidates are loaded with a single query, and
+        streamed in batches.
+        """
+        layout = self.get_layout()
+        candidate_ids = select(Candidate.submission_id).where(
+            Candidate.layout_id == layout.id,
+            Candidate.monitor == Candidate.ALL_MONITORS,
         )
 
-        for subreddit in subreddits:
+        rows = (
+            self.db_session.query(Subreddit, Submission)
+            .outerjoin(
+                Submission,
+                and_(
+                    Submission.subreddit_id == Subreddit.id,
+                    Submission.id.in_(candidate_ids),
+                ),
+            )
+            .order_by(func.lower(Subreddit.name), Subreddit.id, Submission.created_utc)
+            .yield_per(500)
+        )
+
+        for subreddit, subreddit_rows in groupby(rows, key=itemgetter(0)):
             print("\n/r/%s" % subreddit.name)
             print("---%s" % (len(subreddit.name) * "-"))
-            submissions = (
-                self.db_session.query(Submission)
-                .filter(
-                    Submission.subreddit_id == subreddit.id,
-                    Submission.image_height_px >= self.image_height,
-                    Submission.image_width_px >= self.image_width,
-                )
-                .order_by(Submission.created_utc)
-                .all()
-            )
 
-            for submission in submissions:
-                print(submission.pprint())
+            for _, submission in subreddit_rows:
+                if submission is not None:
+                    print(submission.pprint())
@@ -1,168 +1,476 @@
 """Gather images from Reddit"""
-# pylint: disable=ungrouped-imports
+# pylint: disable=too-many-instance-attributes,too-many-locals,ungrouped-imports
 import logging
 import os
-from datetime import datetime
+from collections import Counter, defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 from urllib.parse import urlparse
 
-import requests
-from PIL import Image
-from PIL.Image import DecompressionBombError
-from praw import Reddit
-from requests.exceptions import HTTPError, TooManyRedirects
+from requests.exceptions import RequestException
+from sqlalchemy import func
 from sqlalchemy.orm.exc import NoResultFound
 
+from .downloading import Downloader, ImageTooSmall, normalize_image_url
+from .election import update_layout_candidates
+from .hashing import file_sha256, image_dhash
+from .listing import ListingEngine, created_utc
+from .metrics import RunMetrics
 from .models import Submission, Subreddit
+from .persistence import SubmissionWriter
+from .probing import probe_image_file
+from .scanning import file_stats
+from .storage import BlobStore
 
 
 class Gatherer:
-    """Gather information from Reddit and download submissions"""
+    """Gather information from Reddit and download submissions
+
+    Subreddits are listed concurrently, see listing.ListingEngine, and their
+    submissions are processed from the calling thread as soon as each
+    subreddit has been listed, while images are downloaded by a pool of
+    worker threads; database writes are always
+    performed from the calling thread, so the SQLAlchemy session is never
+    shared between threads.
+
+    Submissions are inserted in batches, and committed either once all
+    submissions from a subreddit have been processed, or at the end of the
+    run; an interrupted run is rolled back to the last commit.
+    """
 
     def __init__(self, config, db_session):
         """Load configuration and prepare resources"""
-        self.reddit = Reddit(
-            client_id=config.reddit_client_id,
-            client_secret=config.reddit_client_secret,
-            user_agent=config.reddit_user_agent,
-        )
+        self.metrics = RunMetrics()
+        self.summary_filename = config.gather_summary
+        self.prometheus_filename = config.prometheus_textfile
+
+        self.lister = ListingEngine(config, self.metrics)
 
         self.data_dir = config.data_dir
-        self.submission_limit = config.submission_limit
         self.subreddits = config.subreddits
-        self.time_filter = config.time_filter
+        self.incremental = config.incremental
+
+        # identifiers of the submissions already saved to the database, of
+        # those whose image has been removed, and digests of their images
+        self.known_post_ids = set()
+        self.removed_post_ids = set()
+        self.known_sha256 = {}
+
+        # database identifiers of known submissions whose download failed, by
+        # post identifier; their image is fetched again on every run
+        self.failed_submissions = {}
+
+        # images being downloaded during this run, by normalized URL
+        self.url_downloads = {}
+
+        self.download_workers = config.download_workers
+        self.downloader = Downloader(config, self.metrics)
+        self.blob_store = BlobStore(config.data_dir) if config.content_store else None
 
         self.db_session = db_session
+        self.db_commit = config.db_commit
+        self.writer = SubmissionWriter(
+            db_session, config.db_flush_size, config.db_flush_interval, self.metrics
+        )
+
+        # subreddits being listed, and their submissions being downloaded
+        self.listing = set()
+        self.outstanding = Counter()
+        self.unsaved = defaultdict(list)
 
     def download_top_submissions(self):
         """Get top submissions from the configured subreddits"""
-        for subreddit in self.subreddits:
+        pending = {}
+
+        with self.downloader, self.writer, ThreadPoolExecutor(
+            max_workers=self.download_workers
+        ) as executor:
             try:
-                db_subreddit = (
-                    self.db_session.query(Subreddit).filter_by(name=subreddit).one()
-                )
-            except NoResultFound:
-                db_subreddit = Subreddit(name=subreddit)
-                self.db_session.add(db_subreddit)
-                self.db_session.commit()
+                for subreddit, submissions in self.lister.list_subreddits(
+                    self.subreddits, self.load_high_water_marks()
+                ):
+                    self.gather_subreddit(executor, pending, subreddit, submissions)
+
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self.save_downloaded_submissions(pending, done)
+            except BaseException:
+                # the executor waits for its queue to be drained when exiting,
+                # interrupted runs only wait for the downloads in progress;
+                # unlike shutdown(cancel_futures=True), this works with 3.8
+                for future in pending:
+                    future.cancel()
+                raise
 
-            storage_dir = os.path.join(self.data_dir, subreddit)
-            os.makedirs(storage_dir, exist_ok=True)
+        with self.metrics.timer("candidates"):
+            update_layout_candidates(self.db_session)
 
-            for submission in self.get_subreddit_top_submissions(subreddit):
-                if "v.reddit" in submission.domain:
-                    continue
-                self.download_submission(storage_dir, db_subreddit, submission)
+        self.metrics.finish()
+        self.write_summary()
 
-    def get_subreddit_top_submissions(self, subreddit):
-        """Get top submissions from a subreddit"""
+    def write_summary(self):
+        """Log the run summary, and write it as JSON and Prometheus metrics"""
+        summary = self.metrics.summary()
         logging.info(
-            "Gathering the top %d submissions from /r/%s for this %s",
-            self.submission_limit,
-            subreddit,
-            self.time_filter,
+            "Gathered %d submissions in %.1f seconds",
+            summary["counters"].get("submissions_saved", 0),
+            summary["duration"],
         )
 
-        return self.reddit.subreddit(subreddit).top(
-            limit=self.submission_limit, time_filter=self.time_filter
+        if self.summary_filename:
+            self.metrics.write_json(self.summary_filename)
+        if self.prometheus_filename:
+            self.metrics.write_prometheus(self.prometheus_filename)
+
+    def gather_subreddit(self, executor, pending, subreddit, submissions):
+        """Schedule the download of new submissions from a subreddit"""
+        try:
+            db_subreddit = (
+                self.db_session.query(Subreddit).filter_by(name=subreddit).one()
+            )
+        except NoResultFound:
+            db_subreddit = Subreddit(name=subreddit)
+            self.db_session.add(db_subreddit)
+            self.db_session.flush()
+
+        self.listing.add(db_subreddit.id)
+
+        storage_dir = os.path.join(self.data_dir, subreddit)
+        os.makedirs(storage_dir, exist_ok=True)
+
+        self.load_known_submissions(db_subreddit)
+        skipped = 0
+
+        for submission in submissions:
+            if "v.reddit" in submission.domain:
+                continue
+
+            if submission.id in self.removed_post_ids or (
+                self.incremental
+                and submission.id in self.known_post_ids
+                and submission.id not in self.failed_submissions
+            ):
+                skipped += 1
+                continue
+
+            if len(submission.title) > 75:
+                logged_title = submission.title[:75] + "..."
+            else:
+                logged_title = submission.title
+            logging.info("Saving: %s", logged_title)
+
+            filename = self.submission_filename(storage_dir, submission)
+            url_key = normalize_image_url(submission.url)
+            # known submissions are processed again in full mode, their
+            # image is not to be reused from another submission
+            source = None
+            if submission.id not in self.known_post_ids:
+                source = self.find_image_source(url_key)
+
+            if source:
+                future = executor.submit(
+                    self.reuse_submission_image, source, submission.url, filename
+                )
+            else:
+                future = executor.submit(
+                    self.fetch_submission_image,
+                    submission.url,
+                    filename,
+                    self.known_sha256.get(submission.id),
+                )
+                self.url_downloads[url_key] = (filename, future)
+
+            pending[future] = (db_subreddit, submission, filename)
+            self.outstanding[db_subreddit.id] += 1
+
+            # save what has been downloaded so far while listing
+            done, _ = wait(pending, timeout=0)
+            self.save_downloaded_submissions(pending, done)
+
+        if skipped:
+            logging.info("Skipped %d known submissions from /r/%s", skipped, subreddit)
+            self.metrics.count("submissions_skipped", skipped)
+
+        self.listing.discard(db_subreddit.id)
+        self.complete_subreddit(db_subreddit)
+
+    def load_high_water_marks(self):
+        """Get the high-water marks of subreddits, by name, in incremental mode
+
+        The high-water mark of a subreddit is the creation date of its most
+        recent known submission; older submissions are not listed from the
+        chronological listing, see listing.ListingEngine. Known submissions
+        from other listings are skipped by identifier.
+        """
+        if not self.incremental:
+            return {}
+
+        return dict(
+            self.db_session.query(Subreddit.name, func.max(Submission.created_utc))
+            .join(Submission, Submission.subreddit_id == Subreddit.id)
+            .group_by(Subreddit.name)
         )
 
-    def download_submission(self, storage_dir, db_subreddit, submission):
-        """Save a submission's content along with its metadata"""
-        # pylint: disable=too-many-locals
-        if len(submission.title) > 75:
-            logged_title = submission.title[:75] + "..."
-        else:
-            logged_title = submission.title
-        logging.info("Saving: %s", logged_title)
+    def load_known_submissions(self, db_subreddit):
+        """Load the identifiers of a subreddit's known submissions
+
+        Images that have been downloaded, then found missing by a rescan, have
+        been removed by the user: they are neither downloaded again nor
+        restored from the content store. Images that could not be downloaded,
+        and whose dimensions are unknown, are fetched again.
+        """
+        for row in self.db_session.query(
+            Submission.id,
+            Submission.post_id,
+            Submission.image_downloaded,
+            Submission.image_sha256,
+            Submission.image_width_px,
+        ).filter(Submission.subreddit_id == db_subreddit.id):
+            submission_id, post_id, image_downloaded, image_sha256, width = row
+            self.known_post_ids.add(post_id)
+
+            if not image_sha256:
+                if not image_downloaded and width is None:
+                    self.failed_submissions[post_id] = submission_id
+                continue
+
+            if image_downloaded:
+                self.known_sha256[post_id] = image_sha256
+            else:
+                self.removed_post_ids.add(post_id)
 
+    @staticmethod
+    def submission_filename(storage_dir, submission):
+        """Get the local filename for a submission's image"""
         parsed_url = urlparse(submission.url)
-        filename = os.path.join(
+        return os.path.join(
             storage_dir, submission.id + "-" + os.path.basename(parsed_url.path)
         )
 
+    def find_image_source(self, url_key):
+        """Find an image that has already been gathered from the same URL
+
+        Returns the image's filename and properties, or a future to them if
+        the image is being downloaded; returns None if the URL is unknown.
+        """
+        if url_key in self.url_downloads:
+            return self.url_downloads[url_key]
+
+        source = (
+            self.db_session.query(
+                Submission.image_filename,
+                Submission.image_height_px,
+                Submission.image_width_px,
+                Submission.image_sha256,
+                Submission.image_dhash,
+            )
+            .filter(
+                Submission.url_key == url_key,
+                Submission.image_downloaded.is_(True),
+            )
+            .first()
+        )
+
+        if source is None:
+            return None
+
+        return source.image_filename, {
+            "image_downloaded": True,
+            "image_height_px": source.image_height_px,
+            "image_width_px": source.image_width_px,
+            "image_sha256": source.image_sha256,
+            "image_dhash": source.image_dhash,
+            "image_mtime": None,
+            "image_size": None,
+        }
+
+    def reuse_submission_image(self, source, submission_url, filename):
+        """Link an image that has already been gathered from the same URL
+
+        The image is downloaded if the source image could not be gathered,
+        or is not available anymore.
+
+        This method is run by the download workers, and must not access the
+        database session.
+        """
+        source_filename, image = source
+        if isinstance(image, Future):
+            # sources are always submitted first, the download is in progress
+            image = image.result()
+
+        if not image.get("image_downloaded"):
+            return self.fetch_submission_image(submission_url, filename)
+
+        if not os.path.exists(filename):
+            try:
+                os.link(source_filename, filename)
+            except FileExistsError:
+                pass
+            except OSError as err:
+                if not (
+                    image.get("image_sha256")
+                    and self.blob_store
+                    and self.blob_store.link(image["image_sha256"], filename)
+                ):
+                    logging.debug("Cannot reuse %s: %s", source_filename, err)
+                    return self.fetch_submission_image(submission_url, filename)
+
+        logging.info("Same URL, reusing %s", source_filename)
+        self.metrics.count("images_reused")
+        return dict(image, **file_stats(filename))
+
+    def fetch_submission_image(self, submission_url, filename, image_sha256=None):
+        """Download a submission's image and read its properties
+
+        If the image of a known submission has been removed, it is restored
+        from the content store rather than downloaded again.
+
+        This method is run by the download workers, and must not access the
+        database session.
+        """
+        image = {
+            "image_downloaded": True,
+            "image_height_px": None,
+            "image_width_px": None,
+            "image_sha256": None,
+            "image_dhash": None,
+            "image_mtime": None,
+            "image_size": None,
+        }
+
         # download the image linked to the submission
         if os.path.exists(filename):
             logging.debug("File exists, skipping download: %s", filename)
-            image_downloaded = True
+        elif (
+            image_sha256
+            and self.blob_store
+            and self.blob_store.link(image_sha256, filename)
+        ):
+            logging.info("Restored from the content store: %s", filename)
+            self.metrics.count("images_restored")
         else:
             try:
-                download_submission_image(submission.url, filename)
-                image_downloaded = True
-            except (HTTPError, TooManyRedirects):
-                image_downloaded = False
+                self.downloader.download(submission_url, filename)
+            except ImageTooSmall as err:
+                image["image_downloaded"] = False
+                image["image_height_px"] = err.height
+                image["image_width_px"] = err.width
+                self.metrics.count("images_too_small")
+                return image
+            except RequestException:
+                image["image_downloaded"] = False
+                self.metrics.count("downloads_failed")
+                return image
+
+            self.metrics.count("images_downloaded")
 
         # enrich metadata with the image's properties
         try:
-            image = Image.open(filename)
-            image_height_px = image.height
-            image_width_px = image.width
-        except (FileNotFoundError, OSError) as err:
+            with self.metrics.timer("probe"):
+                dimensions = probe_image_file(filename)
+            with self.metrics.timer("sha256"):
+                image["image_sha256"] = file_sha256(filename)
+        except OSError as err:
             logging.error("Error reading %s: %s", filename, err)
-            image_height_px = None
-            image_width_px = None
-        except DecompressionBombError as err:
-            logging.error("File too large %s: %s", filename, err)
-            image_height_px = None
-            image_width_px = None
-
-        # prepare metadata
+            return image
+
+        if dimensions is None:
+            logging.error("Unsupported image format: %s", filename)
+        else:
+            image["image_width_px"], image["image_height_px"] = dimensions
+
+        with self.metrics.timer("dhash"):
+            image["image_dhash"] = image_dhash(filename)
+
+        if self.blob_store:
+            with self.metrics.timer("content_store"):
+                self.blob_store.add(filename, image["image_sha256"])
+
+        image.update(file_stats(filename))
+        return image
+
+    def save_downloaded_submissions(self, pending, done):
+        """Save metadata for submissions whose download is complete"""
+        for future in done:
+            db_subreddit, submission, filename = pending.pop(future)
+
+            try:
+                image = future.result()
+            except Exception as err:  # pylint: disable=broad-except
+                logging.error("Error downloading %s: %s", submission.url, err)
+                image = {"image_downloaded": False}
+
+            self.save_submission(db_subreddit, submission, filename, image)
+
+            self.outstanding[db_subreddit.id] -= 1
+            self.complete_subreddit(db_subreddit)
+
+    def complete_subreddit(self, db_subreddit):
+        """Commit a subreddit's submissions once they have all been processed"""
+        if self.db_commit != "subreddit":
+            return
+
+        if db_subreddit.id in self.listing or self.outstanding[db_subreddit.id]:
+            return
+
+        rows = self.unsaved.pop(db_subreddit.id, [])
+        for row in rows:
+            self.write_submission(row)
+        self.writer.commit()
+
+        logging.info("Saved %d submissions from /r/%s", len(rows), db_subreddit.name)
+
+    def save_submission(self, db_subreddit, submission, filename, image):
+        """Save a submission's metadata, along with its image's properties"""
+        # save metadata for future usage, or complete the metadata of a known
+        # submission whose image has now been downloaded
+        if submission.id in self.known_post_ids:
+            if not (
+                image.get("image_downloaded")
+                and submission.id in self.failed_submissions
+            ):
+                return
+
+            row = dict(
+                id=self.failed_submissions.pop(submission.id),
+                image_filename=filename,
+                **image,
+            )
+            logging.info("Recovered the image of %s", submission.id)
+        else:
+            row = self.submission_row(db_subreddit, submission, filename, image)
+            self.known_post_ids.add(submission.id)
+
+        if self.db_commit == "subreddit":
+            self.unsaved[db_subreddit.id].append(row)
+        else:
+            self.write_submission(row)
+
+    def submission_row(self, db_subreddit, submission, filename, image):
+        """Get the database row of a new submission"""
         try:
             author = submission.author.name
         except AttributeError:
             author = "[deleted]"
 
-        created_utc = datetime.fromtimestamp(int(float(submission.created_utc)))
+        return dict(
+            subreddit_id=db_subreddit.id,
+            post_id=submission.id,
+            author=author,
+            created_utc=created_utc(submission),
+            domain=submission.domain,
+            over_18=submission.over_18,
+            permalink=submission.permalink,
+            score=submission.score,
+            title=submission.title,
+            url=submission.url,
+            url_key=normalize_image_url(submission.url),
+            image_filename=filename,
+            **image,
+        )
 
-        # save metadata for future usage
-        try:
-            db_submission = (
-                self.db_session.query(Submission).filter_by(post_id=submission.id).one()
-            )
-        except NoResultFound:
-            db_submission = Submission(
-                subreddit_id=db_subreddit.id,
-                post_id=submission.id,
-                author=author,
-                created_utc=created_utc,
-                domain=submission.domain,
-                over_18=submission.over_18,
-                permalink=submission.permalink,
-                score=submission.score,
-                title=submission.title,
-                url=submission.url,
-                image_downloaded=image_downloaded,
-                image_filename=filename,
-                image_height_px=image_height_px,
-                image_width_px=image_width_px,
-            )
-            self.db_session.add(db_submission)
-            self.db_session.commit()
-
-
-def download_submission_image(submission_url, filename):
-    """Download the image linked to a submission"""
-    logging.info("Downloading %s", submission_url)
-
-    headers = {
-        "Accept-Encoding": "gzip, deflate, sdch",
-        "Accept-Language": "en-US,en;q=0.8",
-        "Upgrade-Insecure-Requests": "1",
-        "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"
-        + " (KHTML, like Gecko) Chrome/56.0.2924.87"
-        + " Safari/537.36",
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,"
-        + "image/webp,*/*;q=0.8",
-        "Cache-Control": "max-age=0",
-        "Connection": "keep-alive",
-    }
-
-    try:
-        response = requests.get(submission_url, headers=headers)
-        response.raise_for_status()
-
-        with open(os.path.join(filename), "wb") as f_img:
-            f_img.write(response.content)
-
-    except (HTTPError, TooManyRedirects) as err:
-        logging.error(err)
-        raise
+    def write_submission(self, row):
+        """Buffer a submission row, updating it if it is already known"""
+        if "id" in row:
+            self.writer.update(**row)
+        else:
+            self.writer.add(**row)
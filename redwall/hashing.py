@@ -0,0 +1,64 @@
+"""Cryptographic and perceptual image hashes"""
+import hashlib
+
+from .models import DHASH_BAND_BITS, DHASH_BAND_MASK
+
+HASH_CHUNK_SIZE = 1024 * 1024
+DHASH_MASK = (1 << 64) - 1
+
+
+def file_sha256(filename):
+    """Compute the SHA-256 digest of a file"""
+    digest = hashlib.sha256()
+
+    with open(filename, "rb") as f_in:
+        for chunk in iter(lambda: f_in.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def image_dhash(filename):
+    """Compute the 64-bit difference hash of an image
+
+    The image is reduced to a 9x8 grayscale thumbnail, and each bit tells
+    whether a pixel is brighter than its right neighbour. JPEG images are
+    decoded at a reduced scale.
+
+    The hash is returned as a signed integer, to fit in a SQL BIGINT column;
+    returns None if the image cannot be decoded.
+    """
+    # Pillow is imported on first use, so that importing this module from the
+    # election does not slow down the command-line startup
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+    from PIL.Image import DecompressionBombError
+
+    try:
+        with Image.open(filename) as image:
+            image.draft("L", (64, 64))
+            pixels = list(
+                image.convert("L").resize((9, 8), Image.Resampling.BILINEAR).getdata()
+            )
+    except (DecompressionBombError, OSError):
+        return None
+
+    dhash = 0
+    for row in range(8):
+        for col in range(8):
+            dhash = (dhash << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+
+    if dhash >= 1 << 63:
+        dhash -= 1 << 64
+
+    return dhash
+
+
+def hamming_distance(dhash1, dhash2):
+    """Count the differing bits of two difference hashes"""
+    return bin((dhash1 ^ dhash2) & DHASH_MASK).count("1")
+
+
+def dhash_band(dhash, band):
+    """Extract a 16-bit band from a difference hash"""
+    return (dhash >> (band * DHASH_BAND_BITS)) & DHASH_BAND_MASK
@@ -0,0 +1,211 @@
+"""List subreddit submissions from several Reddit listings
+
+Each subreddit is browsed through the configured listings, e.g. the top
+submissions of the month and of all time, and the newest submissions; a
+submission appearing in several listings is only returned once.
+
+Subreddits are listed concurrently, each by a worker thread with its own PRAW
+instance, as PRAW is not thread-safe. All workers share the same OAuth rate
+limit, hence requests are scheduled by a shared budget, fed by the
+``X-Ratelimit-*`` headers of Reddit responses: the remaining requests are
+spread evenly until the end of the rate limit window.
+
+In incremental mode, the ``new`` listing, sorted by creation date, is only
+browsed down to the most recent known submission of each subreddit; other
+listings are sorted by score or activity, and are always browsed in full.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from praw import Reddit
+from prawcore import Requestor
+from prawcore.exceptions import PrawcoreException
+
+from .metrics import RunMetrics
+
+# requests that are kept in reserve until the rate limit window is renewed
+RATE_LIMIT_RESERVE = 2
+
+# listing sorted by creation date, most recent first
+CHRONOLOGICAL_LISTING = "new"
+
+
+def created_utc(submission):
+    """Get the creation date of a Reddit submission"""
+    return datetime.fromtimestamp(int(float(submission.created_utc)))
+
+
+class RateBudget:
+    """Schedule requests sharing the same Reddit rate limit"""
+
+    def __init__(self, metrics, reserve=RATE_LIMIT_RESERVE):
+        """Prepare an unknown budget, until the first response is received"""
+        self.metrics = metrics
+        self.reserve = reserve
+        self.lock = threading.Lock()
+
+        self.remaining = None
+        self.reset_at = None
+        self.next_request_at = 0.0
+
+    def acquire(self):
+        """Wait until a request can be sent"""
+        with self.lock:
+            now = time.monotonic()
+
+            if self.reset_at is not None and now >= self.reset_at:
+                # the rate limit window has been renewed
+                self.remaining = None
+                self.reset_at = None
+
+            if self.remaining is None:
+                start = now
+            elif self.remaining <= self.reserve:
+                start = max(now, self.reset_at)
+            else:
+                start = max(now, self.next_request_at)
+                interval = (self.reset_at - start) / (self.remaining - self.reserve)
+                self.next_request_at = start + max(0, interval)
+
+            if self.remaining is not None:
+                # account for requests that have not been answered yet
+                self.remaining -= 1
+
+        self.metrics.count("reddit_requests")
+        if start > now:
+            logging.debug("Reddit rate limit: waiting %.1f seconds", start - now)
+            self.metrics.record("rate_limit_wait", start - now)
+            time.sleep(start - now)
+
+    def update(self, headers):
+        """Update the budget from the rate limit headers of a response"""
+        if "x-ratelimit-remaining" not in headers:
+            return
+
+        with self.lock:
+            self.remaining = int(float(headers["x-ratelimit-remaining"]))
+            self.reset_at = time.monotonic() + int(headers["x-ratelimit-reset"])
+
+
+class BudgetedRequestor(Requestor):
+    """Send Reddit API requests within a shared rate limit budget"""
+
+    def __init__(self, *args, budget=None, **kwargs):
+        """Attach the shared budget"""
+        super().__init__(*args, **kwargs)
+        self.budget = budget
+
+    def request(self, *args, **kwargs):
+        """Wait for the budget to allow a request, then send it"""
+        self.budget.acquire()
+        response = super().request(*args, **kwargs)
+        self.budget.update(response.headers)
+        return response
+
+
+class ListingEngine:
+    """List the submissions of several subreddits concurrently"""
+
+    def __init__(self, config, metrics=None):
+        """Load configuration and prepare resources"""
+        self.config = config
+        self.listings = config.listings
+        self.submission_limit = config.submission_limit
+        self.workers = config.listing_workers
+
+        self.metrics = metrics or RunMetrics()
+        self.budget = RateBudget(self.metrics)
+        self.local = threading.local()
+
+    def get_reddit(self):
+        """Get the PRAW instance of the current thread"""
+        if not hasattr(self.local, "reddit"):
+            self.local.reddit = Reddit(
+                client_id=self.config.reddit_client_id,
+                client_secret=self.config.reddit_client_secret,
+                user_agent=self.config.reddit_user_agent,
+                requestor_class=BudgetedRequestor,
+                requestor_kwargs={"budget": self.budget},
+            )
+
+        return self.local.reddit
+
+    def list_subreddit(self, subreddit, high_water_mark=None):
+        """Get the submissions of a subreddit from all listings, without duplicates
+
+        The chronological listing stops at the first submission created
+        before the high-water mark, if any.
+        """
+        reddit_subreddit = self.get_reddit().subreddit(subreddit)
+        submissions = {}
+
+        for listing_type, time_filter in self.listings:
+            kwargs = {"limit": self.submission_limit}
+            if time_filter is not None:
+                kwargs["time_filter"] = time_filter
+                logging.info(
+                    "Gathering the %d %s submissions from /r/%s for this %s",
+                    self.submission_limit,
+                    listing_type,
+                    subreddit,
+                    time_filter,
+                )
+            else:
+                logging.info(
+                    "Gathering the %d %s submissions from /r/%s",
+                    self.submission_limit,
+                    listing_type,
+                    subreddit,
+                )
+
+            with self.metrics.timer("listing"):
+                for submission in getattr(reddit_subreddit, listing_type)(**kwargs):
+                    if (
+                        high_water_mark is not None
+                        and listing_type == CHRONOLOGICAL_LISTING
+                        and created_utc(submission) <= high_water_mark
+                    ):
+                        break
+
+                    submissions.setdefault(submission.id, submission)
+                    self.metrics.count("submissions_listed")
+
+        return list(submissions.values())
+
+    def list_subreddits(self, subreddits, high_water_marks=None):
+        """List subreddits concurrently
+
+        Yields ``(subreddit, submissions)`` tuples as soon as each subreddit
+        has been listed; subreddits that cannot be listed are skipped.
+        High-water marks are given by subreddit name, see list_subreddit.
+        """
+        high_water_marks = high_water_marks or {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(
+                    self.list_subreddit, subreddit, high_water_marks.get(subreddit)
+                ): subreddit
+                for subreddit in subreddits
+            }
+
+            for future in as_completed(futures):
+                subreddit = futures[future]
+
+                try:
+                    submissions = future.result()
+                except PrawcoreException as err:
+                    logging.error("Cannot list /r/%s: %s", subreddit, err)
+                    self.metrics.count("listing_failures")
+                    continue
+
+                yield subreddit, submissions
+
+        logging.info(
+            "Listed %d subreddits with %d Reddit API requests",
+            len(subreddits),
+            self.metrics.counters["reddit_requests"],
+        )
@@ -0,0 +1,180 @@
+"""Timings and counters of a gathering run
+
+Stages, e.g. listing a subreddit, downloading or probing an image, are timed
+from any thread; at the end of the run, a summary is written as JSON and,
+optionally, in the Prometheus text format, for the node exporter's textfile
+collector.
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+PROMETHEUS_PREFIX = "redwall_gather"
+
+
+def replace_file(filename, content):
+    """Write a file atomically, so that readers never see a partial file"""
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    part_filename = filename + ".part"
+    with open(part_filename, "w", encoding="utf-8") as f_part:
+        f_part.write(content)
+    os.replace(part_filename, filename)
+
+
+class RunMetrics:
+    """Thread-safe timings and counters"""
+
+    def __init__(self):
+        """Start the run"""
+        self.lock = threading.Lock()
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.monotonic()
+        self.finished = None
+
+        self.counters = Counter()
+        self.stages = defaultdict(lambda: {"calls": 0, "seconds": 0.0, "max": 0.0})
+        self.hosts = defaultdict(Counter)
+
+    def count(self, name, value=1):
+        """Increment a counter"""
+        with self.lock:
+            self.counters[name] += value
+
+    def record(self, stage, seconds):
+        """Record the duration of a stage"""
+        with self.lock:
+            timing = self.stages[stage]
+            timing["calls"] += 1
+            timing["seconds"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        """Time the enclosed block as a stage"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, time.monotonic() - start)
+
+    def add_download(self, host, size, seconds, failed=False):
+        """Record a download from a host"""
+        with self.lock:
+            counters = self.hosts[host]
+            counters["downloads"] += 1
+            counters["failures"] += int(failed)
+            counters["bytes"] += size
+            counters["seconds"] += seconds
+
+    def finish(self):
+        """Stop the run clock"""
+        self.finished = time.monotonic()
+
+    def summary(self):
+        """Get the run summary, as a JSON-serializable dictionary"""
+        with self.lock:
+            duration = (self.finished or time.monotonic()) - self.started
+
+            return {
+                "started_at": self.started_at.isoformat(),
+                "duration": round(duration, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "stages": {
+                    stage: {
+                        "calls": timing["calls"],
+                        "seconds": round(timing["seconds"], 3),
+                        "mean_seconds": round(timing["seconds"] / timing["calls"], 3),
+                        "max_seconds": round(timing["max"], 3),
+                    }
+                    for stage, timing in sorted(self.stages.items())
+                },
+                "hosts": {
+                    host: {
+                        "downloads": counters["downloads"],
+                        "failures": counters["failures"],
+                        "bytes": counters["bytes"],
+                        "seconds": round(counters["seconds"], 3),
+                        "bytes_per_second": (
+                            round(counters["bytes"] / counters["seconds"])
+                            if counters["seconds"]
+                            else 0
+                        ),
+                    }
+                    for host, counters in sorted(self.hosts.items())
+                },
+            }
+
+    def write_json(self, filename):
+        """Write the run summary as JSON"""
+        replace_file(filename, json.dumps(self.summary(), indent=2) + "\n")
+
+    def write_prometheus(self, filename):
+        """Write the run summary in the Prometheus text format"""
+        summary = self.summary()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            name = "%s_%s" % (PROMETHEUS_PREFIX, name)
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if labels:
+                    labels = ",".join(
+                        '%s="%s"' % (key, str(label).replace('"', '\\"'))
+                        for key, label in labels.items()
+                    )
+                    lines.append("%s{%s} %s" % (name, labels, value))
+                else:
+                    lines.append("%s %s" % (name, value))
+
+        metric(
+            "last_run_timestamp_seconds",
+            "gauge",
+            "Start time of the last gathering run",
+            [(None, self.started_at.timestamp())],
+        )
+        metric(
+            "duration_seconds",
+            "gauge",
+            "Duration of the last gathering run",
+            [(None, summary["duration"])],
+        )
+        metric(
+            "events",
+            "gauge",
+            "Events counted during the last gathering run",
+            [({"event": name}, value) for name, value in summary["counters"].items()],
+        )
+        metric(
+            "stage_seconds",
+            "gauge",
+            "Time spent in each stage during the last gathering run",
+            [({"stage": name}, t["seconds"]) for name, t in summary["stages"].items()],
+        )
+        metric(
+            "stage_calls",
+            "gauge",
+            "Number of times each stage ran during the last gathering run",
+            [({"stage": name}, t["calls"]) for name, t in summary["stages"].items()],
+        )
+        for key, help_text in (
+            ("downloads", "Downloads from each host"),
+            ("failures", "Failed downloads from each host"),
+            ("bytes", "Bytes downloaded from each host"),
+            ("seconds", "Time spent downloading from each host"),
+        ):
+            metric(
+                "host_%s" % key,
+                "gauge",
+                "%s during the last gathering run" % help_text,
+                [({"host": host}, c[key]) for host, c in summary["hosts"].items()],
+            )
+
+        replace_file(filename, "\n".join(lines) + "\n")
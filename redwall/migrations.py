@@ -0,0 +1,240 @@
+"""Database schema creation and migrations
+
+``Base.metadata.create_all`` only creates missing tables, and never alters
+existing ones; changes to existing tables are applied by the migration
+functions listed in ``MIGRATIONS``, in order. The version of a database is
+the number of migrations that have been applied to it.
+
+Migrations are also applied to new databases, after ``create_all``, and must
+therefore leave an up-to-date schema untouched.
+
+Up-to-date databases are detected with a single query, and ``create_all`` is
+then skipped: new tables must also be created by a migration.
+"""
+import logging
+import re
+
+from sqlalchemy import bindparam, func, inspect, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.schema import CreateIndex
+
+from .models import (
+    DHASH_BANDS,
+    Base,
+    Candidate,
+    History,
+    Layout,
+    SchemaVersion,
+    Submission,
+    Subreddit,
+    SubredditStats,
+)
+from .search import create_search_index
+
+
+def add_columns(conn, table, *names):
+    """Add columns to an existing table"""
+    existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+
+    for name in names:
+        if name in existing:
+            continue
+
+        column = table.c[name]
+        conn.execute(
+            text(
+                "ALTER TABLE %s ADD COLUMN %s %s"
+                % (table.name, column.name, column.type.compile(conn.dialect))
+            )
+        )
+
+
+def create_indexes(conn, *names):
+    """Create indexes that do not exist yet
+
+    Expression-based indexes cannot be reflected, hence the existence check is
+    left to the database.
+    """
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in names:
+                statement = str(CreateIndex(index).compile(conn))
+                conn.execute(
+                    text(
+                        re.sub(
+                            r"^CREATE (UNIQUE )?INDEX",
+                            r"CREATE \1INDEX IF NOT EXISTS",
+                            statement,
+                        )
+                    )
+                )
+
+
+def deduplicate(conn, column, references):
+    """Merge rows sharing the same value for a column that is to be made unique
+
+    The row with the lowest identifier is kept, and foreign keys referencing
+    the duplicates are updated to reference it.
+    """
+    table = column.table
+    duplicates = conn.execute(
+        select(func.min(table.c.id), column)
+        .group_by(column)
+        .having(func.count(table.c.id) > 1)
+    ).fetchall()
+
+    for kept_id, value in duplicates:
+        duplicate_ids = select(table.c.id).where(column == value, table.c.id != kept_id)
+
+        for reference in references:
+            conn.execute(
+                reference.table.update()
+                .where(reference.in_(duplicate_ids))
+                .values({reference.name: kept_id})
+            )
+
+        conn.execute(table.delete().where(table.c.id.in_(duplicate_ids)))
+        logging.warning("Merged duplicate %s rows for '%s'", table.name, value)
+
+
+def add_indexes(conn):
+    """Index lookup columns, and make post IDs and subreddit names unique"""
+    deduplicate(conn, Subreddit.__table__.c.name, [Submission.__table__.c.subreddit_id])
+    deduplicate(
+        conn, Submission.__table__.c.post_id, [History.__table__.c.submission_id]
+    )
+
+    create_indexes(
+        conn,
+        "ix_history_submission_id",
+        "ix_submissions_post_id",
+        "ix_submissions_resolution",
+        "ix_submissions_subreddit_id",
+        "ix_subreddits_name",
+    )
+
+
+def add_image_hashes(conn):
+    """Add content and perceptual image hashes"""
+    add_columns(conn, Submission.__table__, "image_sha256", "image_dhash")
+    create_indexes(
+        conn,
+        "ix_submissions_image_sha256",
+        *("ix_submissions_dhash_band%d" % band for band in range(DHASH_BANDS)),
+    )
+
+
+def add_url_keys(conn):
+    """Index submissions by normalized image URL"""
+    add_columns(conn, Submission.__table__, "url_key")
+    create_indexes(conn, "ix_submissions_url_key")
+    fill_url_keys(conn)
+
+
+def fill_url_keys(conn):
+    """Compute missing normalized image URLs"""
+    # pylint: disable=import-outside-toplevel
+    from .downloading import normalize_image_url
+
+    table = Submission.__table__
+    rows = conn.execute(
+        select(table.c.id, table.c.url).where(
+            table.c.url.isnot(None), table.c.url_key.is_(None)
+        )
+    ).fetchall()
+
+    if rows:
+        conn.execute(
+            table.update()
+            .where(table.c.id == bindparam("submission_id"))
+            .values(url_key=bindparam("key")),
+            [
+                {"submission_id": submission_id, "key": normalize_image_url(url)}
+                for submission_id, url in rows
+            ],
+        )
+
+
+def add_candidate_weights(conn):
+    """Add selection weights to candidates"""
+    add_columns(
+        conn, Candidate.__table__, "subreddit_id", "weight", "cumulative_weight"
+    )
+    create_indexes(conn, "ix_candidates_weight")
+
+    # candidates are rebuilt on the next election
+    conn.execute(Candidate.__table__.delete())
+    conn.execute(Layout.__table__.delete())
+
+
+def add_colors(conn):
+    """Add the dominant and background colors of images"""
+    add_columns(conn, Submission.__table__, "dominant_color", "background_color")
+
+
+def add_file_stats(conn):
+    """Record the modification time and size of image files"""
+    add_columns(conn, Submission.__table__, "image_mtime", "image_size")
+
+    # candidates are now restricted to downloaded images, and rebuilt on the
+    # next election
+    conn.execute(Candidate.__table__.delete())
+    conn.execute(Layout.__table__.update().values(max_submission_id=0))
+
+
+def add_stats_summary(conn):
+    """Add the statistics summary table"""
+    SubredditStats.__table__.create(conn, checkfirst=True)
+
+
+def add_history_hosts(conn):
+    """Record the host each wallpaper is selected on"""
+    add_columns(conn, History.__table__, "host")
+    create_indexes(conn, "ix_history_host")
+
+
+def update_url_keys(conn):
+    """Keep resized Reddit previews and query strings in normalized image URLs"""
+    conn.execute(Submission.__table__.update().values(url_key=None))
+    fill_url_keys(conn)
+
+
+MIGRATIONS = [
+    add_indexes,
+    create_search_index,
+    add_image_hashes,
+    add_url_keys,
+    add_candidate_weights,
+    add_colors,
+    add_file_stats,
+    add_stats_summary,
+    add_history_hosts,
+    update_url_keys,
+]
+
+
+def schema_version(engine):
+    """Get the version of a database, 0 if its schema has not been created"""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+    except DBAPIError:
+        return 0
+
+
+def migrate(engine):
+    """Create the database schema, or upgrade it to the latest version"""
+    if schema_version(engine) >= len(MIGRATIONS):
+        return
+
+    Base.metadata.create_all(engine)
+
+    with engine.begin() as conn:
+        version = conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+        for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            logging.info(
+                "Migrating database to version %d: %s", version, migration.__doc__
+            )
+            migration(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(version=version))
@@ -1,12 +1,30 @@
 """Models"""
 # pylint: disable=invalid-name,too-few-public-methods
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Column, ForeignKey, Index, or_
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, literal_column
+from sqlalchemy.types import BigInteger, Boolean, DateTime, Float, Integer, String
 
 Base = declarative_base()
 
+# a 64-bit dHash is split in 4 bands of 16 bits; two hashes within a Hamming
+# distance of 3 have at least one identical band
+DHASH_BANDS = 4
+DHASH_BAND_BITS = 16
+DHASH_BAND_MASK = (1 << DHASH_BAND_BITS) - 1
+
+
+def dhash_band_expression(column, band):
+    """SQL expression extracting a 16-bit band from a dHash column
+
+    Shifts and masks are rendered as literals, so that queries match the
+    expression indexes on bands.
+    """
+    return column.op(">>")(literal_column(str(band * DHASH_BAND_BITS))).op("&")(
+        literal_column(str(DHASH_BAND_MASK))
+    )
+
 
 class Subreddit(Base):
     """Subreddit representation"""
@@ -14,7 +32,7 @@ class Subreddit(Base):
     __tablename__ = "subreddits"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True, unique=True)
     submissions = relationship("Submission", back_populates="subreddit")
 
     def __repr__(self):
@@ -28,10 +46,10 @@ class Submission(Base):
 
     id = Column(Integer, primary_key=True)
 
-    subreddit_id = Column(Integer, ForeignKey("subreddits.id"))
+    subreddit_id = Column(Integer, ForeignKey("subreddits.id"), index=True)
     subreddit = relationship("Subreddit", back_populates="submissions")
 
-    post_id = Column(String)
+    post_id = Column(String, index=True, unique=True)
 
     author = Column(String)
     created_utc = Column(DateTime)
@@ -41,11 +59,30 @@ class Submission(Base):
     score = Column(Integer)
     title = Column(String)
     url = Column(String)
+    url_key = Column(String, index=True)
 
     image_downloaded = Column(Boolean)
     image_filename = Column(String)
     image_height_px = Column(Integer)
     image_width_px = Column(Integer)
+    image_sha256 = Column(String, index=True)
+    image_dhash = Column(BigInteger)
+
+    # file modification time and size when last probed, see scanning.Scanner
+    image_mtime = Column(Float)
+    image_size = Column(BigInteger)
+
+    # "#rrggbb" colors, see rendering.render_submission
+    dominant_color = Column(String)
+    background_color = Column(String)
+
+    __table_args__ = (
+        Index("ix_submissions_resolution", "image_width_px", "image_height_px"),
+        Index("ix_submissions_dhash_band0", dhash_band_expression(image_dhash, 0)),
+        Index("ix_submissions_dhash_band1", dhash_band_expression(image_dhash, 1)),
+        Index("ix_submissions_dhash_band2", dhash_band_expression(image_dhash, 2)),
+        Index("ix_submissions_dhash_band3", dhash_band_expression(image_dhash, 3)),
+    )
 
     def __repr__(self):
         return "<Submission(subreddit='%s', id='%s', title='%s')>" % (
@@ -76,6 +113,13 @@ class Submission(Base):
 
     def pprint(self):
         """Pretty-printable string representation"""
+        colors = "N/A"
+        if self.dominant_color:
+            colors = "%s dominant, %s background" % (
+                self.dominant_color,
+                self.background_color,
+            )
+
         try:
             return (
                 "Title        %s\n"
@@ -84,6 +128,7 @@ class Submission(Base):
                 "Post URL     %s\n"
                 "Image URL    %s\n"
                 "Image size   %d x %d\n"
+                "Colors       %s\n"
                 "Filename     %s"
             ) % (
                 self.title,
@@ -93,6 +138,7 @@ class Submission(Base):
                 self.url,
                 int(self.image_width_px),
                 int(self.image_height_px),
+                colors,
                 self.image_filename,
             )
         except TypeError:
@@ -103,6 +149,7 @@ class Submission(Base):
                 "Post URL     %s\n"
                 "Image URL    %s\n"
                 "Image size   N/A\n"
+                "Colors       %s\n"
                 "Filename     %s"
             ) % (
                 self.title,
@@ -110,6 +157,7 @@ class Submission(Base):
                 self.created_utc,
                 self.post_url,
                 self.url,
+                colors,
                 self.image_filename,
             )
 
@@ -120,12 +168,116 @@ class History(Base):
     __tablename__ = "history"
 
     id = Column(Integer, primary_key=True)
-    submission_id = Column(Integer, ForeignKey("submissions.id"))
+    submission_id = Column(Integer, ForeignKey("submissions.id"), index=True)
     submission = relationship("Submission")
     date = Column(DateTime, server_default=func.now())
 
+    # host the selection was made on, when several share the same database
+    host = Column(String, index=True)
+
     def __repr__(self):
         return "<History(id='%s', title='%s')>" % (
             self.submission.post_id,
             self.submission.title,
         )
+
+    @staticmethod
+    def selected_on(host):
+        """Filter selections made on a host, or before hosts were recorded"""
+        return or_(History.host == host, History.host.is_(None))
+
+
+class Layout(Base):
+    """Monitor layout, for which suitable submissions are materialized"""
+
+    __tablename__ = "layouts"
+
+    id = Column(Integer, primary_key=True)
+    signature = Column(String, index=True, unique=True)
+    aspect_ratio_tolerance = Column(Float)
+
+    # submissions with a greater ID have not been considered as candidates yet
+    max_submission_id = Column(Integer, default=0)
+    date = Column(DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return "<Layout(signature='%s')>" % (self.signature)
+
+
+class Candidate(Base):
+    """Submission suitable for a monitor layout
+
+    Candidates are numbered from 0 for each monitor, or for the whole layout
+    when using the same image for all monitors (ALL_MONITORS).
+
+    The cumulative weight is the sum of the weights of the candidates from the
+    same subreddit, up to and including this one, so that a weighted random
+    candidate can be looked up on an index.
+    """
+
+    __tablename__ = "candidates"
+
+    ALL_MONITORS = -1
+
+    layout_id = Column(Integer, ForeignKey("layouts.id"), primary_key=True)
+    monitor = Column(Integer, primary_key=True)
+    position = Column(Integer, primary_key=True)
+    submission_id = Column(Integer, ForeignKey("submissions.id"))
+    submission = relationship("Submission")
+    subreddit_id = Column(Integer, ForeignKey("subreddits.id"))
+    weight = Column(Float)
+    cumulative_weight = Column(Float)
+
+    __table_args__ = (
+        Index("ix_candidates_submission", "layout_id", "monitor", "submission_id"),
+        Index(
+            "ix_candidates_weight",
+            "layout_id",
+            "monitor",
+            "subreddit_id",
+            "cumulative_weight",
+        ),
+    )
+
+    def __repr__(self):
+        return "<Candidate(layout='%s', monitor='%s', position='%s')>" % (
+            self.layout_id,
+            self.monitor,
+            self.position,
+        )
+
+
+class SubredditStats(Base):
+    """Aggregated submissions of a subreddit, for a resolution tier
+
+    See stats.update_stats_summary.
+    """
+
+    __tablename__ = "subreddit_stats"
+
+    subreddit_id = Column(Integer, ForeignKey("subreddits.id"), primary_key=True)
+    resolution_tier = Column(String, primary_key=True)
+    submissions = Column(Integer)
+    downloaded = Column(Integer)
+    image_bytes = Column(BigInteger)
+
+    # submissions with a greater ID have not been aggregated yet
+    max_submission_id = Column(Integer)
+
+    def __repr__(self):
+        return "<SubredditStats(subreddit='%s', resolution_tier='%s')>" % (
+            self.subreddit_id,
+            self.resolution_tier,
+        )
+
+
+class SchemaVersion(Base):
+    """Database schema migrations that have been applied"""
+
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
+    date = Column(DateTime, server_default=func.now())
+
+    def __repr__(self):
+        return "<SchemaVersion(version='%s')>" % (self.version)
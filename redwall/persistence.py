@@ -0,0 +1,89 @@
+"""Batched persistence of gathered submissions"""
+import logging
+import time
+
+from .metrics import RunMetrics
+from .models import Submission
+
+
+class SubmissionWriter:
+    """Buffer submission inserts and updates, and write them in batches
+
+    Buffered rows are bulk-written once ``flush_size`` rows are pending, or
+    ``flush_interval`` seconds after the previous flush; flushed rows are only
+    made persistent when the transaction is committed, so that an interrupted
+    gathering run can be rolled back cleanly.
+    """
+
+    def __init__(self, db_session, flush_size, flush_interval, metrics=None):
+        """Prepare the write buffers"""
+        self.db_session = db_session
+        self.metrics = metrics or RunMetrics()
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self.rows = []
+        self.updates = []
+        self.last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def add(self, **row):
+        """Buffer a submission to be inserted"""
+        self.rows.append(row)
+        self.flush_if_needed()
+
+    def update(self, **row):
+        """Buffer a known submission to be updated, given its identifier"""
+        self.updates.append(row)
+        self.flush_if_needed()
+
+    def flush_if_needed(self):
+        """Write buffered submissions if enough are pending, or enough time passed"""
+        if (
+            len(self.rows) + len(self.updates) >= self.flush_size
+            or time.monotonic() - self.last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write buffered submissions in the current transaction"""
+        if self.rows:
+            logging.debug("Inserting %d submissions", len(self.rows))
+            with self.metrics.timer("db_flush"):
+                self.db_session.bulk_insert_mappings(Submission, self.rows)
+            self.metrics.count("submissions_saved", len(self.rows))
+            self.rows = []
+
+        if self.updates:
+            logging.debug("Updating %d submissions", len(self.updates))
+            with self.metrics.timer("db_flush"):
+                self.db_session.bulk_update_mappings(Submission, self.updates)
+            self.metrics.count("submissions_updated", len(self.updates))
+            self.updates = []
+
+        self.last_flush = time.monotonic()
+
+    def commit(self):
+        """Write buffered submissions and commit the current transaction"""
+        self.flush()
+        with self.metrics.timer("db_commit"):
+            self.db_session.commit()
+
+    def rollback(self):
+        """Discard buffered submissions and roll back the current transaction"""
+        if self.rows or self.updates:
+            logging.warning(
+                "Discarding %d unsaved submissions", len(self.rows) + len(self.updates)
+            )
+
+        self.rows = []
+        self.updates = []
+        self.db_session.rollback()
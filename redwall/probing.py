@@ -0,0 +1,105 @@
+"""Read image dimensions from file headers, without decoding images"""
+import io
+import struct
+
+# JPEG EXIF/XMP/ICC segments may push the frame header far from the start
+PROBE_MAX_BYTES = 512 * 1024
+
+# start of frame markers, excluding DHT, JPG and DAC
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+JPEG_STANDALONE_MARKERS = {0x01} | set(range(0xD0, 0xD8))
+
+
+def probe_image_size(f_img):
+    """Read the dimensions of a JPEG, PNG, GIF or WebP image
+
+    Only the image header is read from the given binary file object, which
+    must be seekable.
+
+    Returns a ``(width, height)`` tuple, or None if the format is not supported
+    or the header is truncated.
+    """
+    head = f_img.read(30)
+
+    try:
+        if head.startswith(b"\xff\xd8"):
+            f_img.seek(2)
+            return probe_jpeg(f_img)
+
+        if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+
+        if head[:6] in (b"GIF87a", b"GIF89a"):
+            return struct.unpack("<HH", head[6:10])
+
+        if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+            return probe_webp(head)
+
+    except struct.error:
+        # truncated header
+        return None
+
+    return None
+
+
+def probe_image_file(filename):
+    """Read the dimensions of an image file, see probe_image_size"""
+    with open(filename, "rb") as f_img:
+        return probe_image_size(f_img)
+
+
+def probe_image_bytes(data):
+    """Read the dimensions of a (partial) image, see probe_image_size"""
+    return probe_image_size(io.BytesIO(data))
+
+
+def probe_jpeg(f_img):
+    """Walk JPEG segments until the frame header is found"""
+    while True:
+        byte = f_img.read(1)
+        if not byte:
+            return None
+        if byte != b"\xff":
+            continue
+
+        # markers may be preceded by any number of fill bytes
+        marker = f_img.read(1)
+        while marker == b"\xff":
+            marker = f_img.read(1)
+        if not marker:
+            return None
+
+        marker = marker[0]
+        if marker in JPEG_STANDALONE_MARKERS:
+            continue
+        if marker in (0xD9, 0xDA):
+            # end of image, or start of scan without a frame header
+            return None
+
+        (length,) = struct.unpack(">H", f_img.read(2))
+
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">xHH", f_img.read(5))
+            return width, height
+
+        f_img.seek(length - 2, io.SEEK_CUR)
+
+
+def probe_webp(head):
+    """Read the dimensions from a WebP header"""
+    chunk = head[12:16]
+
+    if chunk == b"VP8 ":
+        width, height = struct.unpack("<HH", head[26:30])
+        return width & 0x3FFF, height & 0x3FFF
+
+    if chunk == b"VP8L":
+        (bits,) = struct.unpack("<I", head[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+
+    if chunk == b"VP8X":
+        width = int.from_bytes(head[24:27], "little") + 1
+        height = int.from_bytes(head[27:30], "little") + 1
+        return width, height
+
+    return None
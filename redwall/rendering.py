@@ -0,0 +1,229 @@
+"""Pre-render candidates to the resolution of the monitors they are shown on
+
+Each candidate of a known monitor layout is scaled and cropped to fill the
+monitors it may be displayed on, so that setting a wallpaper requires no
+decoding or resizing. Rendered images are stored under
+``<data_dir>/.rendered/<width>x<height>``, named after the image digest.
+
+Images are decoded once for all resolutions, by a pool of worker processes;
+their dominant and background colors are computed at the same time.
+"""
+import logging
+import os
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from .election import parse_layout_signature
+from .models import Candidate, Layout, Submission
+
+RENDERED_DIR = ".rendered"
+RENDER_QUALITY = 92
+
+# colors are computed from a thumbnail, quantized to a few colors
+COLOR_SAMPLE_SIZE = (64, 64)
+DOMINANT_COLORS = 8
+
+# number of rendered submissions whose colors are saved together
+RENDER_BATCH_SIZE = 100
+
+
+def rendered_filename(data_dir, submission, width, height):
+    """Get the filename of a submission rendered for a given resolution"""
+    name = submission.image_sha256 or submission.post_id
+
+    return os.path.join(
+        data_dir, RENDERED_DIR, "%dx%d" % (width, height), "%s.jpg" % name
+    )
+
+
+def hex_color(rgb):
+    """Format a RGB color as #rrggbb"""
+    return "#%02x%02x%02x" % tuple(rgb[:3])
+
+
+def render_submission(image_filename, targets):
+    """Render an image for several resolutions, and compute its colors
+
+    This function runs in worker processes; targets is a list of
+    ``(width, height, filename)`` tuples.
+
+    The background color is the average color of the image; the dominant
+    color is the most frequent color once the image is reduced to a few
+    colors.
+
+    Returns a ``(dominant_color, background_color)`` tuple, or None if the
+    image cannot be decoded.
+    """
+    # pylint: disable=import-outside-toplevel,too-many-locals
+    from PIL import Image, ImageOps
+    from PIL.Image import DecompressionBombError
+
+    # JPEG images are decoded at the smallest scale covering all resolutions
+    draft_size = COLOR_SAMPLE_SIZE
+    if targets:
+        draft_size = (
+            max(width for width, _, _ in targets),
+            max(height for _, height, _ in targets),
+        )
+
+    try:
+        with Image.open(image_filename) as image:
+            image.draft("RGB", draft_size)
+            image = image.convert("RGB")
+    except (DecompressionBombError, OSError) as err:
+        logging.warning("Cannot render %s: %s", image_filename, err)
+        return None
+
+    for width, height, filename in targets:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        part_filename = filename + ".part"
+
+        rendered = ImageOps.fit(image, (width, height), Image.Resampling.LANCZOS)
+        rendered.save(part_filename, "JPEG", quality=RENDER_QUALITY)
+        os.replace(part_filename, filename)
+
+    sample = image.copy()
+    sample.thumbnail(COLOR_SAMPLE_SIZE)
+
+    background = sample.resize((1, 1), Image.Resampling.BOX).getpixel((0, 0))
+
+    quantized = sample.quantize(DOMINANT_COLORS)
+    _, index = max(quantized.getcolors())
+    palette = quantized.getpalette()
+    dominant = palette[3 * index], palette[3 * index + 1], palette[3 * index + 2]
+
+    return hex_color(dominant), hex_color(background)
+
+
+class Renderer:
+    """Render the candidates of all known monitor layouts"""
+
+    def __init__(self, config, db_session, workers=None):
+        """Load configuration and prepare resources"""
+        self.data_dir = config.data_dir
+        self.db_session = db_session
+        self.workers = workers or config.render_workers or os.cpu_count()
+
+    def get_render_sizes(self):
+        """Get the monitor resolutions each candidate is rendered for"""
+        render_sizes = defaultdict(set)
+
+        for layout in self.db_session.query(Layout).all():
+            monitor_sizes = [
+                (monitor.width, monitor.height)
+                for monitor in parse_layout_signature(layout.signature)
+            ]
+
+            rows = self.db_session.query(
+                Candidate.submission_id, Candidate.monitor
+            ).filter(Candidate.layout_id == layout.id)
+
+            for submission_id, monitor in rows.yield_per(1000):
+                if monitor == Candidate.ALL_MONITORS:
+                    render_sizes[submission_id].update(monitor_sizes)
+                else:
+                    render_sizes[submission_id].add(monitor_sizes[monitor])
+
+        return render_sizes
+
+    def get_jobs(self):
+        """Find candidates with missing renderings or colors"""
+        render_sizes = self.get_render_sizes()
+
+        rows = (
+            self.db_session.query(
+                Submission.id,
+                Submission.post_id,
+                Submission.image_filename,
+                Submission.image_sha256,
+                Submission.dominant_color,
+            )
+            .filter(Submission.image_downloaded.is_(True))
+            .order_by(Submission.id)
+        )
+
+        for row in rows.yield_per(1000):
+            if row.id not in render_sizes or not os.path.isfile(row.image_filename):
+                continue
+
+            targets = [
+                (width, height, filename)
+                for width, height in sorted(render_sizes[row.id])
+                for filename in [rendered_filename(self.data_dir, row, width, height)]
+                if not os.path.exists(filename)
+            ]
+
+            if targets or row.dominant_color is None:
+                yield row.id, row.image_filename, targets
+
+    def render(self):
+        """Render candidates, and save their colors
+
+        Returns the number of rendered submissions.
+        """
+        pending = {}
+        colors = []
+        rendered = 0
+
+        # colors are committed while rendering, hence jobs are listed first
+        jobs = list(self.get_jobs())
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for submission_id, image_filename, targets in jobs:
+                future = executor.submit(render_submission, image_filename, targets)
+                pending[future] = submission_id
+
+                # bound the number of queued jobs
+                if len(pending) >= self.workers * 4:
+                    rendered += self.collect(pending, colors, FIRST_COMPLETED)
+
+            rendered += self.collect(pending, colors)
+
+        self.save_colors(colors)
+
+        return rendered
+
+    def collect(self, pending, colors, return_when=None):
+        """Collect the results of finished jobs, or wait for all of them"""
+        # pylint: disable=broad-except
+        if return_when is None:
+            done, _ = wait(pending)
+        else:
+            done, _ = wait(pending, return_when=return_when)
+
+        rendered = 0
+        for future in done:
+            submission_id = pending.pop(future)
+
+            try:
+                result = future.result()
+            except Exception as err:
+                logging.error("Error rendering submission %d: %s", submission_id, err)
+                continue
+
+            if result is None:
+                continue
+
+            dominant_color, background_color = result
+            colors.append(
+                {
+                    "id": submission_id,
+                    "dominant_color": dominant_color,
+                    "background_color": background_color,
+                }
+            )
+            rendered += 1
+
+        if len(colors) >= RENDER_BATCH_SIZE:
+            self.save_colors(colors)
+
+        return rendered
+
+    def save_colors(self, colors):
+        """Save the colors of rendered submissions"""
+        if not colors:
+            return
+
+        self.db_session.bulk_update_mappings(Submission, colors)
+        self.db_session.commit()
+        colors.clear()
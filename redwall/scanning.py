@@ -0,0 +1,268 @@
+"""Reconcile the image library with the files of the data directory
+
+Images may be deleted, moved or added outside of Redwall; the data directory
+is walked, and each file is matched with the submission it belongs to:
+
+- files whose modification time and size match the recorded ones are left
+  untouched;
+- other files are probed again, by a pool of worker processes, to read their
+  dimensions and hashes;
+- submissions whose file has disappeared are matched with unknown files by
+  content, then by name, in case they have been moved; otherwise, they are
+  marked as not downloaded.
+
+Finally, blobs of the content store that are not used anymore are removed, see
+storage.BlobStore.
+"""
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from .election import reset_layout_candidates
+from .hashing import file_sha256, image_dhash
+from .models import Submission
+from .probing import probe_image_file
+from .stats import format_size, reset_stats_summary
+from .storage import BlobStore
+
+# files that are being written, see downloading.Downloader and storage.BlobStore
+TEMPORARY_SUFFIXES = (".link", ".part")
+
+# number of submissions updated together
+SCAN_BATCH_SIZE = 500
+
+
+def file_stats(filename):
+    """Get the modification time and size of an image file"""
+    stat = os.stat(filename)
+    return {"image_mtime": stat.st_mtime, "image_size": stat.st_size}
+
+
+def scan_directory(path, files):
+    """Find image files under a directory, with their modification time and size
+
+    Hidden files and directories, e.g. the content store, are skipped.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or entry.name.endswith(TEMPORARY_SUFFIXES):
+                continue
+
+            if entry.is_dir(follow_symlinks=False):
+                scan_directory(entry.path, files)
+            elif entry.is_file(follow_symlinks=False):
+                stat = entry.stat(follow_symlinks=False)
+                files[os.path.normpath(entry.path)] = (stat.st_mtime, stat.st_size)
+
+
+def scan_data_dir(data_dir):
+    """Find the image files of all subreddit directories"""
+    files = {}
+
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            # the database and configuration files live at the top level
+            if entry.name.startswith(".") or not entry.is_dir(follow_symlinks=False):
+                continue
+
+            scan_directory(entry.path, files)
+
+    return files
+
+
+def probe_file(filename):
+    """Read the dimensions and hashes of an image file
+
+    This function runs in worker processes.
+    """
+    image = {
+        "image_height_px": None,
+        "image_width_px": None,
+        "image_sha256": None,
+        "image_dhash": None,
+    }
+
+    try:
+        dimensions = probe_image_file(filename)
+        image["image_sha256"] = file_sha256(filename)
+        image.update(file_stats(filename))
+    except OSError as err:
+        logging.error("Error reading %s: %s", filename, err)
+        return None
+
+    if dimensions is not None:
+        image["image_width_px"], image["image_height_px"] = dimensions
+
+    image["image_dhash"] = image_dhash(filename)
+
+    return image
+
+
+class Scanner:
+    """Reconcile submissions with the files of the data directory"""
+
+    def __init__(self, config, db_session, workers=None):
+        """Load configuration and prepare resources"""
+        self.data_dir = config.data_dir
+        self.blob_store = BlobStore(config.data_dir)
+        self.db_session = db_session
+        self.workers = workers or os.cpu_count()
+
+    def rescan(self):
+        """Reconcile submissions with image files
+
+        Returns a counter of unchanged, updated, moved and missing images, of
+        untracked files, and of removed blobs.
+        """
+        files = scan_data_dir(self.data_dir)
+        counts = Counter()
+
+        rows = (
+            self.db_session.query(
+                Submission.id,
+                Submission.image_filename,
+                Submission.image_downloaded,
+                Submission.image_width_px,
+                Submission.image_sha256,
+                Submission.image_mtime,
+                Submission.image_size,
+            )
+            .filter(Submission.image_filename.isnot(None))
+            .order_by(Submission.id)
+            .all()
+        )
+
+        # submission IDs by filename, for files that must be probed again
+        probes = {}
+        missing = []
+
+        for row in rows:
+            stat = files.pop(os.path.normpath(row.image_filename), None)
+
+            if stat is None:
+                if row.image_downloaded:
+                    missing.append(row)
+                continue
+
+            if (
+                row.image_downloaded
+                and (row.image_mtime, row.image_size) == stat
+                and row.image_width_px is not None
+                and row.image_sha256 is not None
+            ):
+                counts["unchanged"] += 1
+                continue
+
+            probes[os.path.normpath(row.image_filename)] = row.id
+
+        # the remaining files are not known, they may have been moved
+        untracked = list(files)
+        results = self.probe(list(probes) + untracked)
+
+        updates = []
+        for filename, submission_id in probes.items():
+            image = results.get(filename)
+            if image is None:
+                continue
+
+            updates.append(dict(image, id=submission_id, image_downloaded=True))
+            counts["updated"] += 1
+
+        for row, filename in self.find_moved_images(missing, untracked, results):
+            if filename is None:
+                logging.warning("Missing image: %s", row.image_filename)
+                updates.append({"id": row.id, "image_downloaded": False})
+                counts["missing"] += 1
+                continue
+
+            logging.info("Moved image: %s -> %s", row.image_filename, filename)
+            updates.append(
+                dict(
+                    results[filename],
+                    id=row.id,
+                    image_filename=filename,
+                    image_downloaded=True,
+                )
+            )
+            untracked.remove(filename)
+            counts["moved"] += 1
+
+        for filename in untracked:
+            logging.debug("Untracked file: %s", filename)
+        counts["untracked"] = len(untracked)
+
+        self.save(updates)
+        counts["collected"] = self.collect_garbage()
+        return counts
+
+    def probe(self, filenames):
+        """Probe image files in parallel"""
+        if not filenames:
+            return {}
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            return dict(
+                zip(filenames, executor.map(probe_file, filenames, chunksize=16))
+            )
+
+    @staticmethod
+    def find_moved_images(missing, untracked, results):
+        """Match submissions whose image is missing with untracked files
+
+        Files are matched by SHA-256 digest first, then by name; yields
+        ``(row, filename)`` tuples, where filename is None if no file matches.
+        """
+        by_digest = {}
+        by_name = {}
+        for filename in untracked:
+            image = results.get(filename)
+            if image is not None:
+                by_digest.setdefault(image["image_sha256"], filename)
+                by_name.setdefault(os.path.basename(filename), filename)
+
+        matched = set()
+        for row in missing:
+            filename = by_digest.get(row.image_sha256) or by_name.get(
+                os.path.basename(row.image_filename)
+            )
+
+            if filename in matched:
+                filename = None
+            if filename is not None:
+                matched.add(filename)
+
+            yield row, filename
+
+    def collect_garbage(self):
+        """Remove unused blobs from the content store
+
+        Returns the number of removed blobs.
+        """
+        digests = {
+            sha256
+            for (sha256,) in self.db_session.query(Submission.image_sha256)
+            .filter(Submission.image_downloaded.is_(True))
+            .distinct()
+        }
+
+        removed, freed = self.blob_store.collect_garbage(digests)
+        if removed:
+            logging.info(
+                "Removed %d unused blobs, freeing %s", removed, format_size(freed)
+            )
+
+        return removed
+
+    def save(self, updates):
+        """Save updated submissions, and rebuild candidates and statistics"""
+        if not updates:
+            return
+
+        for start in range(0, len(updates), SCAN_BATCH_SIZE):
+            end = start + SCAN_BATCH_SIZE
+            self.db_session.bulk_update_mappings(Submission, updates[start:end])
+
+        reset_layout_candidates(self.db_session)
+        reset_stats_summary(self.db_session)
+        self.db_session.commit()
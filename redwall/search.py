@@ -0,0 +1,181 @@
+"""Full-text search on submission titles and authors
+
+With SQLite, submission titles and authors are indexed in a FTS5 table, kept in
+sync with the submissions table by triggers, so that every insertion made by
+the Gatherer is indexed in the same transaction.
+
+With PostgreSQL, they are indexed by a GIN expression index on their text
+search vector, which the database keeps up to date.
+"""
+import logging
+import re
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, inspect, text
+from sqlalchemy.exc import OperationalError
+
+from .models import Submission
+
+FTS_TABLE = "submissions_fts"
+
+PG_SEARCH_INDEX = "ix_submissions_search"
+PG_SEARCH_VECTOR = (
+    "to_tsvector('simple', coalesce(title, '') || ' ' || coalesce(author, ''))"
+)
+
+# the FTS table is managed by migrations, not by Base.metadata.create_all
+submissions_fts = Table(
+    FTS_TABLE,
+    MetaData(),
+    Column("rowid", Integer, primary_key=True),
+    Column("title", String),
+    Column("author", String),
+)
+
+CREATE_STATEMENTS = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS submissions_fts USING fts5(
+        title,
+        author,
+        content='submissions',
+        content_rowid='id',
+        prefix='2 3',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS submissions_fts_insert
+    AFTER INSERT ON submissions BEGIN
+        INSERT INTO submissions_fts(rowid, title, author)
+        VALUES (new.id, new.title, new.author);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS submissions_fts_delete
+    AFTER DELETE ON submissions BEGIN
+        INSERT INTO submissions_fts(submissions_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS submissions_fts_update
+    AFTER UPDATE OF title, author ON submissions BEGIN
+        INSERT INTO submissions_fts(submissions_fts, rowid, title, author)
+        VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO submissions_fts(rowid, title, author)
+        VALUES (new.id, new.title, new.author);
+    END
+    """,
+]
+
+
+def create_search_index(conn):
+    """Create the full-text search index, if supported by the database"""
+    if conn.dialect.name == "postgresql":
+        conn.execute(
+            text(
+                "CREATE INDEX IF NOT EXISTS %s ON submissions USING gin (%s)"
+                % (PG_SEARCH_INDEX, PG_SEARCH_VECTOR)
+            )
+        )
+        return
+
+    if conn.dialect.name != "sqlite":
+        return
+
+    try:
+        with conn.begin_nested():
+            for statement in CREATE_STATEMENTS:
+                conn.execute(text(statement))
+    except OperationalError as err:
+        logging.warning("Full-text search is not available: %s", err)
+        return
+
+    rebuild_search_index(conn)
+
+
+def rebuild_search_index(conn):
+    """Re-index all submissions"""
+    if conn.dialect.name == "postgresql":
+        conn.execute(text("REINDEX INDEX %s" % PG_SEARCH_INDEX))
+        return
+
+    conn.execute(
+        text("INSERT INTO submissions_fts(submissions_fts) VALUES ('rebuild')")
+    )
+
+
+def has_search_index(db_session):
+    """Check whether the full-text search index exists"""
+    bind = db_session.get_bind()
+
+    if bind.dialect.name == "postgresql":
+        return bool(
+            db_session.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname = :name"),
+                {"name": PG_SEARCH_INDEX},
+            ).scalar()
+        )
+
+    return inspect(bind).has_table(FTS_TABLE)
+
+
+def match_expression(terms):
+    """Build a FTS5 query matching all the words of the given terms
+
+    Each word is quoted, so that FTS5 operators in the user input are not
+    interpreted, and matched as a prefix.
+    """
+    words = re.findall(r"\w+", " ".join(terms))
+    return " ".join('"%s"*' % word for word in words)
+
+
+def tsquery_expression(terms):
+    """Build a PostgreSQL text search query matching all the words of the terms
+
+    Only words are kept, so that operators in the user input are not
+    interpreted, and each word is matched as a prefix.
+    """
+    words = re.findall(r"[^\W_]+", " ".join(terms))
+    return " & ".join("%s:*" % word for word in words)
+
+
+def search_submissions(db_session, terms):
+    """Query submissions matching the given search terms
+
+    Results are ranked by relevance if the full-text search index is
+    available; otherwise, titles containing the search terms are returned in
+    insertion order.
+    """
+    postgresql = db_session.get_bind().dialect.name == "postgresql"
+
+    if postgresql:
+        expression = tsquery_expression(terms)
+    else:
+        expression = match_expression(terms)
+
+    if not expression or not has_search_index(db_session):
+        return (
+            db_session.query(Submission)
+            .filter(Submission.title.ilike("%{}%".format(" ".join(terms))))
+            .order_by(Submission.id.asc())
+        )
+
+    if postgresql:
+        query = "to_tsquery('simple', :expression)"
+        return (
+            db_session.query(Submission)
+            .filter(text("%s @@ %s" % (PG_SEARCH_VECTOR, query)))
+            .params(expression=expression)
+            .order_by(
+                text("ts_rank(%s, %s) DESC" % (PG_SEARCH_VECTOR, query)),
+                Submission.id.asc(),
+            )
+        )
+
+    return (
+        db_session.query(Submission)
+        .join(submissions_fts, submissions_fts.c.rowid == Submission.id)
+        .filter(text("submissions_fts MATCH :expression"))
+        .params(expression=expression)
+        .order_by(text("submissions_fts.rank"), Submission.id.asc())
+    )
@@ -0,0 +1,147 @@
+"""Long-running daemon, serving commands over a Unix domain socket
+
+Commands are sent by the command-line client as a JSON line holding their
+arguments, e.g. ``{"args": ["current", "-f"]}``, and run by the daemon with a
+database session that is kept open between requests; their output and exit
+status are sent back as a JSON line.
+
+Requests are served one at a time, from the main thread; gathering, if
+enabled, runs in a separate thread with its own database session.
+"""
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import threading
+import time
+from contextlib import redirect_stdout, suppress
+
+# commands that can be served by the daemon
+SERVED_COMMANDS = ("current", "info", "random", "search")
+
+# how long the monitor layout is cached, in seconds
+MONITORS_TTL = 60
+
+
+def forward_request(socket_path, args):
+    """Run a command on the daemon
+
+    Returns an ``(output, status)`` tuple, or None if the daemon is not
+    running.
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.connect(socket_path)
+            client.sendall(json.dumps({"args": args}).encode() + b"\n")
+
+            with client.makefile("rb") as response:
+                reply = json.loads(response.readline())
+    except (OSError, ValueError):
+        return None
+
+    return reply["output"], reply["status"]
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """Run a single command"""
+
+    def handle(self):
+        try:
+            args = json.loads(self.rfile.readline())["args"]
+        except (KeyError, TypeError, ValueError):
+            return
+
+        output, status = self.server.run_command(args)
+        self.wfile.write(
+            json.dumps({"output": output, "status": status}).encode() + b"\n"
+        )
+
+
+class Server(socketserver.UnixStreamServer):
+    """Serve commands with a warm database session"""
+
+    def __init__(self, command, config, db_session_factory):
+        """Bind the socket and prepare resources"""
+        with suppress(FileNotFoundError):
+            os.remove(config.socket_path)
+
+        super().__init__(config.socket_path, RequestHandler)
+        os.chmod(config.socket_path, 0o600)
+
+        self.command = command
+        self.config = config
+        self.db_session_factory = db_session_factory
+        self.db_session = db_session_factory()
+        self.monitors_cache = {"monitors": None, "expires": 0}
+
+        self.stopping = threading.Event()
+        self.gatherer_thread = None
+
+    def run_command(self, args):
+        """Run a command, capturing its output and exit status"""
+        # pylint: disable=broad-except
+        if not args or args[0] not in SERVED_COMMANDS:
+            return "Command not served by the daemon: %s\n" % " ".join(args), 2
+
+        output = io.StringIO()
+        status = 0
+        obj = {
+            "config": self.config,
+            "db_session": self.db_session,
+            "monitors_cache": self.monitors_cache,
+        }
+
+        with redirect_stdout(output):
+            try:
+                self.command.main(
+                    args, prog_name="redwall", standalone_mode=False, obj=obj
+                )
+            except SystemExit as err:
+                status = err.code if isinstance(err.code, int) else 1
+            except Exception as err:
+                # click usage errors carry their own exit code
+                status = getattr(err, "exit_code", 1)
+                if hasattr(err, "format_message"):
+                    print("Error: %s" % err.format_message())
+                else:
+                    logging.exception("Error running '%s'", " ".join(args))
+                    print("Error: %s" % err)
+            finally:
+                self.db_session.close()
+
+        return output.getvalue(), status
+
+    def start_gathering(self, interval):
+        """Gather submissions every interval, in seconds, in a separate thread"""
+        self.gatherer_thread = threading.Thread(
+            target=self.gather_periodically, args=(interval,), daemon=True
+        )
+        self.gatherer_thread.start()
+
+    def gather_periodically(self, interval):
+        """Gather submissions until the server is stopped"""
+        # pylint: disable=broad-except,import-outside-toplevel
+        from .gathering import Gatherer
+
+        while not self.stopping.is_set():
+            started = time.monotonic()
+            db_session = self.db_session_factory()
+
+            try:
+                Gatherer(self.config, db_session).download_top_submissions()
+            except Exception:
+                logging.exception("Scheduled gathering failed")
+            finally:
+                db_session.close()
+
+            self.stopping.wait(max(0, interval - (time.monotonic() - started)))
+
+    def server_close(self):
+        """Stop gathering and remove the socket"""
+        self.stopping.set()
+        super().server_close()
+
+        with suppress(FileNotFoundError):
+            os.remove(self.config.socket_path)
@@ -1,22 +1,244 @@
-"""Statistics about local data"""
-from sqlalchemy import func
+"""Statistics about local data
 
-from .models import Submission, Subreddit
+Submissions are aggregated by the database in a single pass, grouped by
+subreddit and resolution tier. Aggregates can also be kept in the
+subreddit_stats summary table, which is updated with the submissions gathered
+since the previous report, so that reports on a large library only read new
+rows; the summary is reset whenever existing submissions are modified, see
+scanning.Scanner.
+"""
+from collections import defaultdict
 
+from sqlalchemy import BigInteger, case, cast, func, literal_column
 
-def display_stats(db_session):
-    """Print statistics about collected submissions"""
-    res = (
-        db_session.query(Subreddit, func.count(Submission.id))
-        .join(Submission)
-        .group_by(Subreddit.id)
-        .order_by(func.lower(Subreddit.name))
+from .models import Candidate, Layout, Submission, Subreddit, SubredditStats
+
+# name, and minimum dimensions of images, in either orientation
+RESOLUTION_TIERS = (
+    ("8K", 7680, 4320),
+    ("5K", 5120, 2880),
+    ("4K", 3840, 2160),
+    ("QHD", 2560, 1440),
+    ("FHD", 1920, 1080),
+    ("HD", 1280, 720),
+)
+SMALLER_TIER = "smaller"
+UNKNOWN_TIER = "unknown"
+
+SIZE_UNITS = ("B", "KB", "MB", "GB", "TB")
+
+
+def resolution_tier():
+    """SQL expression giving the resolution tier of a submission's image"""
+    width = Submission.image_width_px
+    height = Submission.image_height_px
+
+    whens = [((width.is_(None)) | (height.is_(None)), UNKNOWN_TIER)]
+    for name, tier_width, tier_height in RESOLUTION_TIERS:
+        whens.append(
+            (
+                ((width >= tier_width) & (height >= tier_height))
+                | ((width >= tier_height) & (height >= tier_width)),
+                name,
+            )
+        )
+
+    return case(*whens, else_=SMALLER_TIER)
+
+
+def aggregate_submissions(db_session, min_submission_id=0):
+    """Aggregate submissions by subreddit and resolution tier
+
+    Yields ``(subreddit_id, tier, submissions, downloaded, image_bytes,
+    max_submission_id)`` tuples, for submissions with a greater ID than
+    min_submission_id.
+    """
+    tier = resolution_tier().label("tier")
+    downloaded = Submission.image_downloaded.is_(True)
+
+    return (
+        db_session.query(
+            Submission.subreddit_id,
+            tier,
+            func.count(Submission.id),
+            # PostgreSQL sums integers as decimals
+            cast(func.sum(case((downloaded, 1), else_=0)), BigInteger),
+            cast(
+                func.coalesce(func.sum(case((downloaded, Submission.image_size))), 0),
+                BigInteger,
+            ),
+            func.max(Submission.id),
+        ).filter(Submission.id > min_submission_id)
+        # grouping by label keeps the tier expression and its parameters unique
+        .group_by(Submission.subreddit_id, literal_column("tier"))
+    )
+
+
+def update_stats_summary(db_session):
+    """Add the submissions gathered since the last update to the summary"""
+    min_submission_id = (
+        db_session.query(func.max(SubredditStats.max_submission_id)).scalar() or 0
+    )
+
+    summary = {
+        (row.subreddit_id, row.resolution_tier): row
+        for row in db_session.query(SubredditStats)
+    }
+
+    for (
+        subreddit_id,
+        tier,
+        submissions,
+        downloaded,
+        image_bytes,
+        max_submission_id,
+    ) in aggregate_submissions(db_session, min_submission_id):
+        row = summary.get((subreddit_id, tier))
+        if row is None:
+            row = SubredditStats(
+                subreddit_id=subreddit_id,
+                resolution_tier=tier,
+                submissions=0,
+                downloaded=0,
+                image_bytes=0,
+                max_submission_id=0,
+            )
+            db_session.add(row)
+
+        row.submissions += submissions
+        row.downloaded += downloaded
+        row.image_bytes += image_bytes
+        row.max_submission_id = max(row.max_submission_id, max_submission_id)
+
+    db_session.commit()
+
+
+def reset_stats_summary(db_session):
+    """Clear the summary, so that it is rebuilt by the next report"""
+    db_session.query(SubredditStats).delete()
+
+
+def count_candidates(db_session):
+    """Count the candidates of each monitor layout and monitor"""
+    return (
+        db_session.query(Layout.signature, Candidate.monitor, func.count())
+        .join(Candidate, Candidate.layout_id == Layout.id)
+        .group_by(Layout.id, Layout.signature, Candidate.monitor)
+        .order_by(Layout.id, Candidate.monitor)
     )
 
-    grand_total = 0
 
-    for subreddit, submission_total in res:
-        grand_total += int(submission_total)
-        print("{:>5}  {}".format(submission_total, subreddit.name))
+def new_counts():
+    """Get empty counts for a subreddit, or for the whole library"""
+    return {
+        "submissions": 0,
+        "downloaded": 0,
+        "failed": 0,
+        "bytes": 0,
+        "resolutions": dict.fromkeys(
+            [name for name, _, _ in RESOLUTION_TIERS] + [SMALLER_TIER, UNKNOWN_TIER],
+            0,
+        ),
+    }
+
+
+def sum_counts(rows):
+    """Sum aggregates by subreddit, and for the whole library"""
+    subreddits = defaultdict(new_counts)
+    total = new_counts()
+
+    for subreddit_id, tier, submissions, downloaded, image_bytes in rows:
+        for counts in (subreddits[subreddit_id], total):
+            counts["submissions"] += submissions
+            counts["downloaded"] += downloaded
+            counts["failed"] += submissions - downloaded
+            counts["bytes"] += image_bytes
+            counts["resolutions"][tier] += downloaded
+
+    return subreddits, total
+
+
+def collect_stats(db_session, summary=False):
+    """Collect statistics about gathered submissions
+
+    With summary, statistics are read from the incrementally updated summary
+    table rather than aggregated from all submissions.
+    """
+    if summary:
+        update_stats_summary(db_session)
+        rows = db_session.query(
+            SubredditStats.subreddit_id,
+            SubredditStats.resolution_tier,
+            SubredditStats.submissions,
+            SubredditStats.downloaded,
+            SubredditStats.image_bytes,
+        )
+    else:
+        rows = (row[:5] for row in aggregate_submissions(db_session))
+
+    subreddits, total = sum_counts(rows)
+
+    names = dict(db_session.query(Subreddit.id, Subreddit.name))
+    for subreddit_id, counts in subreddits.items():
+        counts["name"] = names.get(subreddit_id)
+
+    layouts = {}
+    for signature, monitor, candidates in count_candidates(db_session):
+        if monitor == Candidate.ALL_MONITORS:
+            monitor = "all"
+        layouts.setdefault(signature, {})[str(monitor)] = candidates
+
+    for counts in list(subreddits.values()) + [total]:
+        counts["failure_rate"] = (
+            counts["failed"] / counts["submissions"] if counts["submissions"] else 0
+        )
+
+    return {
+        "subreddits": sorted(
+            subreddits.values(), key=lambda counts: str(counts["name"]).lower()
+        ),
+        "total": total,
+        "layouts": layouts,
+    }
+
+
+def format_size(size):
+    """Format a size in bytes for humans"""
+    for unit in SIZE_UNITS:
+        if size < 1024 or unit == SIZE_UNITS[-1]:
+            break
+        size /= 1024
+
+    return "%.1f %s" % (size, unit)
+
+
+def display_stats(report):
+    """Print statistics about collected submissions"""
+    line = "{:>11}  {:>10}  {:>6}  {:>9}  {}"
+
+    def print_counts(counts, name):
+        print(
+            line.format(
+                counts["submissions"],
+                counts["downloaded"],
+                "{:.0%}".format(counts["failure_rate"]),
+                format_size(counts["bytes"]),
+                name,
+            )
+        )
+
+    print(line.format("Submissions", "Downloaded", "Failed", "Size", "Subreddit"))
+    for counts in report["subreddits"]:
+        print_counts(counts, counts["name"])
+
+    print("")
+    print_counts(report["total"], "TOTAL")
+
+    print("\nDownloaded images by resolution\n")
+    for tier, downloaded in report["total"]["resolutions"].items():
+        print("{:>11}  {}".format(downloaded, tier))
 
-    print("\n{:>5}  TOTAL".format(grand_total))
+    for signature, monitors in report["layouts"].items():
+        print("\nCandidates for the %s monitor layout\n" % signature)
+        for monitor, candidates in monitors.items():
+            print("{:>11}  monitor {}".format(candidates, monitor))
@@ -0,0 +1,104 @@
+"""Content-addressed image storage
+
+Each distinct image is stored once under ``<data_dir>/.blobs``, named after
+its SHA-256 digest; the files of the subreddit directories are hard links to
+these blobs, so that an image cross-posted to several subreddits only uses
+disk space once.
+
+A blob that is not linked to anymore, or whose image is not referenced by any
+downloaded submission, is garbage: it is removed by ``redwall rescan``, so that
+deleting images from subreddit directories reclaims disk space.
+"""
+import logging
+import os
+from contextlib import suppress
+
+BLOBS_DIR = ".blobs"
+
+
+class BlobStore:
+    """Store images by content"""
+
+    def __init__(self, data_dir):
+        """Set the storage location"""
+        self.blobs_dir = os.path.join(data_dir, BLOBS_DIR)
+
+    def blob_path(self, sha256, filename):
+        """Get the path of the blob for a given digest"""
+        extension = os.path.splitext(filename)[1].lower()
+        return os.path.join(self.blobs_dir, sha256[:2], sha256 + extension)
+
+    def add(self, filename, sha256):
+        """Store a file, or replace it with a link to an identical blob"""
+        blob = self.blob_path(sha256, filename)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+
+        try:
+            os.link(filename, blob)
+            return
+        except FileExistsError:
+            pass
+        except OSError as err:
+            # the filesystem does not support hard links
+            logging.debug("Cannot store %s: %s", filename, err)
+            return
+
+        if os.path.samefile(blob, filename):
+            return
+
+        logging.info("Duplicate image, linking %s to %s", filename, blob)
+        self.link(sha256, filename)
+
+    def link(self, sha256, filename):
+        """Create a file from a stored blob
+
+        Returns False if the blob does not exist.
+        """
+        blob = self.blob_path(sha256, filename)
+        link_filename = filename + ".link"
+
+        with suppress(FileNotFoundError):
+            os.remove(link_filename)
+
+        try:
+            os.link(blob, link_filename)
+        except FileNotFoundError:
+            return False
+        except OSError as err:
+            logging.debug("Cannot link %s: %s", filename, err)
+            return False
+
+        os.replace(link_filename, filename)
+        return True
+
+    def collect_garbage(self, digests):
+        """Remove the blobs that are not linked to, or whose digest is unknown
+
+        Returns the number of removed blobs, and the disk space they used.
+        """
+        removed = 0
+        freed = 0
+
+        if not os.path.isdir(self.blobs_dir):
+            return removed, freed
+
+        for prefix in os.scandir(self.blobs_dir):
+            if not prefix.is_dir(follow_symlinks=False):
+                continue
+
+            for entry in os.scandir(prefix.path):
+                stat = entry.stat(follow_symlinks=False)
+                sha256 = entry.name.split(".")[0]
+
+                if stat.st_nlink > 1 and sha256 in digests:
+                    continue
+
+                logging.debug("Removing blob %s", entry.path)
+                os.remove(entry.path)
+                removed += 1
+
+                if stat.st_nlink == 1:
+                    # other links keep the image on disk
+                    freed += stat.st_size
+
+        return removed, freed
@@ -0,0 +1,161 @@
+"""Export and import the library, e.g. to move it from SQLite to PostgreSQL
+
+The library is written as JSON Lines: a header giving the schema version, then
+for each table, a line giving its name and columns, followed by one line per
+row. Rows are streamed from the database and inserted in batches, so that
+large libraries are transferred in constant memory.
+
+Layouts, candidates and the statistics summary are not exported, as they are
+rebuilt from submissions when needed.
+"""
+import gzip
+import json
+import logging
+import sys
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import func, select, text
+from sqlalchemy.types import DateTime
+
+from .migrations import MIGRATIONS
+from .models import History, Submission, Subreddit
+
+EXPORTED_TABLES = (Subreddit.__table__, Submission.__table__, History.__table__)
+
+# rows fetched or inserted at once
+TRANSFER_BATCH_SIZE = 1000
+
+
+class TransferError(Exception):
+    """Raised when a library cannot be imported"""
+
+
+@contextmanager
+def open_library_file(filename, mode):
+    """Open a library file, compressed if its name ends with .gz
+
+    The standard input or output is used when the filename is "-".
+    """
+    if filename == "-":
+        yield sys.stdout if mode == "w" else sys.stdin
+    elif filename.endswith(".gz"):
+        with gzip.open(filename, mode + "t", encoding="utf-8") as f_library:
+            yield f_library
+    else:
+        with open(filename, mode, encoding="utf-8") as f_library:
+            yield f_library
+
+
+def encode_value(value):
+    """Convert a column value to JSON"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+def export_library(db_session, f_library):
+    """Write the library to a file, and return the number of exported rows"""
+    f_library.write(json.dumps({"schema_version": len(MIGRATIONS)}) + "\n")
+    exported = 0
+
+    for table in EXPORTED_TABLES:
+        columns = [column.name for column in table.columns]
+        f_library.write(json.dumps({"table": table.name, "columns": columns}) + "\n")
+
+        result = db_session.execute(
+            select(table).order_by(*table.primary_key.columns),
+            execution_options={"stream_results": True},
+        )
+        for rows in result.partitions(TRANSFER_BATCH_SIZE):
+            for row in rows:
+                f_library.write(json.dumps([encode_value(value) for value in row]))
+                f_library.write("\n")
+            exported += len(rows)
+
+        logging.info("Exported table %s", table.name)
+
+    return exported
+
+
+def is_empty(db_session):
+    """Check whether the library has no data"""
+    return all(
+        db_session.execute(select(func.count()).select_from(table)).scalar() == 0
+        for table in EXPORTED_TABLES
+    )
+
+
+def reset_sequences(conn):
+    """Restart PostgreSQL ID sequences after the imported rows"""
+    if conn.dialect.name != "postgresql":
+        return
+
+    for table in EXPORTED_TABLES:
+        conn.execute(
+            text(
+                "SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+                "coalesce(max(id), 0) + 1, false) FROM %s" % table.name
+            ),
+            {"table": table.name},
+        )
+
+
+def import_library(db_session, f_library):
+    """Load a library file in an empty database
+
+    Returns the number of imported rows.
+    """
+    header = json.loads(f_library.readline() or "{}")
+    if header.get("schema_version") != len(MIGRATIONS):
+        raise TransferError(
+            "Unsupported schema version %s, expected %d"
+            % (header.get("schema_version"), len(MIGRATIONS))
+        )
+
+    if not is_empty(db_session):
+        raise TransferError("The database is not empty")
+
+    tables = {table.name: table for table in EXPORTED_TABLES}
+    conn = db_session.connection()
+    imported = 0
+    table = columns = None
+    batch = []
+
+    def flush():
+        if batch:
+            conn.execute(table.insert(), batch)
+            batch.clear()
+
+    for line in f_library:
+        data = json.loads(line)
+
+        if isinstance(data, dict):
+            flush()
+            if data.get("table") not in tables:
+                raise TransferError("Unknown table %s" % data.get("table"))
+
+            table = tables[data["table"]]
+            columns = [table.columns[name] for name in data["columns"]]
+            logging.info("Importing table %s", table.name)
+            continue
+
+        if table is None:
+            raise TransferError("Rows found before any table")
+
+        row = {}
+        for column, value in zip(columns, data):
+            if value is not None and isinstance(column.type, DateTime):
+                value = datetime.fromisoformat(value)
+            row[column.name] = value
+
+        batch.append(row)
+        imported += 1
+        if len(batch) >= TRANSFER_BATCH_SIZE:
+            flush()
+
+    flush()
+    reset_sequences(conn)
+    db_session.commit()
+
+    return imported
@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+"""Redwall - Offline benchmark suite
+
+Measures the throughput and latency of commands against a synthetic library,
+without any network access:
+
+- gather: submissions are listed by a fake PRAW instance, and their images
+  served by a local HTTP server, as synthetic JPEG images of the given size;
+- random, list-candidates, search and stats: commands are run in-process, as
+  served by the daemon, against a synthetic database of the given size.
+
+Usage, from a checkout where the package is installed, e.g. with
+``pip install -e .``:
+
+    $ python scripts/benchmark.py [--rows 100000] [--runs 20] [--only random]
+
+Generating a large database takes a while; use --data-dir to keep it between
+runs. Startup times are measured by scripts/benchmark_startup.py.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from redwall.cli import open_database, redwall
+from redwall.config import Config
+from redwall.election import Monitor
+from redwall.models import History, Submission, Subreddit
+
+BENCHMARKS = ["gather", "random", "list-candidates", "search", "stats"]
+
+# a single 1080p monitor, so that the benchmark does not depend on the display
+MONITORS = [Monitor(1920, 1080, 0, 0)]
+
+# synthetic image dimensions, with a higher probability for common ones
+RESOLUTIONS = [
+    (1280, 720),
+    (1920, 1080),
+    (1920, 1080),
+    (2560, 1440),
+    (3840, 2160),
+    (3840, 2160),
+    (5120, 2880),
+    (1080, 1920),
+    (800, 600),
+    (4000, 3000),
+]
+
+WORDS = (
+    "autumn beach bridge canyon castle city cloud coast desert dusk forest "
+    "glacier harbor island lake lighthouse meadow mist moon mountain night "
+    "ocean river road sky snow spring storm sunrise sunset valley waterfall"
+).split()
+
+SUBMISSIONS_ORIGIN = datetime(2012, 1, 1)
+SUBMISSIONS_SPAN = timedelta(days=12 * 365)
+
+INSERT_BATCH_SIZE = 10000
+
+
+def write_config(data_dir, subreddits, extra=""):
+    """Write a configuration file, and load it"""
+    config_path = os.path.join(data_dir, "redwall.ini")
+
+    with open(config_path, "w", encoding="utf-8") as f_config:
+        f_config.write(
+            "[reddit]\nuser_agent = redwall benchmark\nclient_id = benchmark\n"
+            "client_secret = benchmark\n\n[redwall]\ndata_dir = %s\n"
+            "subreddits = %s\n%s" % (data_dir, " ".join(subreddits), extra)
+        )
+
+    return Config([config_path])
+
+
+def synthetic_title(rng):
+    """Get a random title"""
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 8))).capitalize()
+
+
+def synthetic_submission(rng, index, subreddit_ids, data_dir):
+    """Get a random submission, as inserted by the Gatherer"""
+    width, height = rng.choice(RESOLUTIONS)
+    post_id = "b%x" % index
+    url = "https://i.example.com/%s.jpg" % post_id
+
+    return {
+        "subreddit_id": rng.choice(subreddit_ids),
+        "post_id": post_id,
+        "author": "user%d" % rng.randrange(1000),
+        "created_utc": SUBMISSIONS_ORIGIN
+        + timedelta(seconds=rng.random() * SUBMISSIONS_SPAN.total_seconds()),
+        "domain": "i.example.com",
+        "over_18": False,
+        "permalink": "/r/benchmark/comments/%s/" % post_id,
+        "score": int(rng.paretovariate(1.2) * 10),
+        "title": synthetic_title(rng),
+        "url": url,
+        "url_key": url,
+        "image_downloaded": rng.random() > 0.05,
+        "image_filename": os.path.join(data_dir, "benchmark", "%s.jpg" % post_id),
+        "image_width_px": width,
+        "image_height_px": height,
+        "image_sha256": "%064x" % rng.getrandbits(256),
+        "image_dhash": rng.getrandbits(64) - (1 << 63),
+        "image_mtime": time.time(),
+        "image_size": width * height // 4,
+    }
+
+
+def generate_database(config, rows, subreddits, seed):
+    """Fill a database with synthetic submissions and selections"""
+    rng = random.Random(seed)
+    db_session = open_database(config)()
+
+    existing = db_session.query(Submission.id).count()
+    if existing == rows:
+        print("Reusing the %d submissions of %s" % (rows, config.db_filename))
+        return db_session
+    if existing:
+        sys.exit("%s holds another number of submissions" % config.db_filename)
+
+    subreddit_ids = []
+    for name in subreddits:
+        subreddit = Subreddit(name=name)
+        db_session.add(subreddit)
+        db_session.flush()
+        subreddit_ids.append(subreddit.id)
+    db_session.commit()
+
+    started = time.perf_counter()
+    for start in range(0, rows, INSERT_BATCH_SIZE):
+        batch = [
+            synthetic_submission(rng, index, subreddit_ids, config.data_dir)
+            for index in range(start, min(rows, start + INSERT_BATCH_SIZE))
+        ]
+        db_session.bulk_insert_mappings(Submission, batch)
+        db_session.commit()
+
+        print(
+            "Generated %d/%d submissions in %.1f seconds"
+            % (start + len(batch), rows, time.perf_counter() - started),
+            end="\r",
+        )
+    print("")
+
+    for submission_id in rng.sample(range(1, rows + 1), min(rows, 100)):
+        db_session.add(History(submission_id=submission_id))
+    db_session.commit()
+
+    return db_session
+
+
+def run_command(config, db_session, args):
+    """Run a command in-process, as served by the daemon"""
+    obj = {
+        "config": config,
+        "db_session": db_session,
+        "monitors_cache": {"monitors": MONITORS, "expires": float("inf")},
+    }
+
+    with redirect_stdout(io.StringIO()):
+        redwall.main(args, prog_name="redwall", standalone_mode=False, obj=obj)
+    db_session.close()
+
+
+def measure(function, runs):
+    """Time the first call of a function, then the median and 95th percentile"""
+    start = time.perf_counter()
+    function()
+    first = time.perf_counter() - start
+
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    return {
+        "first_ms": first * 1000,
+        "median_ms": statistics.median(timings) * 1000,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        "ops_per_second": len(timings) / sum(timings),
+    }
+
+
+def command_benchmarks(args, selected):
+    """Benchmark commands against a synthetic database"""
+    subreddits = ["Benchmark%02d" % index for index in range(args.subreddits)]
+    config = write_config(args.data_dir, subreddits)
+    db_session = generate_database(config, args.rows, subreddits, args.seed)
+
+    commands = {
+        "random": ["random"],
+        "list-candidates": ["list-candidates"],
+        "search": ["search", "mountain", "lake"],
+        "stats": ["stats", "--json"],
+    }
+
+    results = {}
+    for name, command in commands.items():
+        if name in selected:
+            results[name] = measure(
+                lambda command=command: run_command(config, db_session, command),
+                args.runs,
+            )
+
+    return results
+
+
+def jpeg_image(width, height, seed):
+    """Encode a noisy JPEG image, so that its size is realistic"""
+    # pylint: disable=import-outside-toplevel
+    from PIL import Image
+
+    noise = Image.effect_noise((width, height), 64)
+    image = Image.merge(
+        "RGB",
+        [
+            noise,
+            noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+            Image.new("L", (width, height), seed % 256),
+        ],
+    )
+
+    buffer = io.BytesIO()
+    image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue()
+
+
+class ImageServer(ThreadingHTTPServer):
+    """Serve synthetic images, e.g. /<variant>/<post_id>.jpg"""
+
+    daemon_threads = True
+
+    def __init__(self, width, height, variants):
+        """Encode the images and listen on a local port"""
+        self.images = [jpeg_image(width, height, seed) for seed in range(variants)]
+        super().__init__(("127.0.0.1", 0), ImageRequestHandler)
+
+    @property
+    def base_url(self):
+        """Get the URL of the server"""
+        return "http://127.0.0.1:%d" % self.server_port
+
+
+class ImageRequestHandler(BaseHTTPRequestHandler):
+    """Serve a synthetic image"""
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Send the image variant of the requested path"""
+        try:
+            variant = int(self.path.split("/")[1])
+            body = self.server.images[variant]
+        except (IndexError, ValueError):
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        """Do not log requests"""
+
+
+class FakeSubreddit:
+    """Listings of a synthetic subreddit"""
+
+    def __init__(self, name, base_url, variants):
+        """Prepare the listings"""
+        self.name = name
+        self.base_url = base_url
+        self.variants = variants
+
+    def listing(self, kind, limit):
+        """Generate submissions, whose identifiers depend on the listing"""
+        rng = random.Random("%s/%s" % (self.name, kind))
+
+        for index in range(limit):
+            post_id = "%s%s%d" % (self.name.lower(), kind, index)
+            yield SimpleNamespace(
+                id=post_id,
+                title=synthetic_title(rng),
+                url="%s/%d/%s.jpg"
+                % (self.base_url, rng.randrange(self.variants), post_id),
+                domain="i.example.com",
+                author=SimpleNamespace(name="user%d" % rng.randrange(100)),
+                created_utc=time.time() - rng.random() * 86400 * 30,
+                over_18=False,
+                permalink="/r/%s/comments/%s/" % (self.name, post_id),
+                score=rng.randrange(10000),
+            )
+
+    def top(self, limit=None, time_filter="all"):
+        """List top submissions"""
+        return self.listing("t" + time_filter, limit)
+
+    def new(self, limit=None):
+        """List new submissions"""
+        return self.listing("new", limit)
+
+
+class FakeReddit:  # pylint: disable=too-few-public-methods
+    """PRAW stand-in, listing synthetic subreddits"""
+
+    base_url = None
+    variants = 1
+
+    def __init__(self, **kwargs):
+        """Ignore credentials"""
+
+    def subreddit(self, name):
+        """Get a synthetic subreddit"""
+        return FakeSubreddit(name, self.base_url, self.variants)
+
+
+def gather_benchmark(args):
+    """Benchmark a gathering run against the local image server"""
+    # pylint: disable=import-outside-toplevel
+    from redwall import listing
+    from redwall.gathering import Gatherer
+
+    width, height = (int(value) for value in args.image_size.split("x"))
+    server = ImageServer(width, height, args.image_variants)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    FakeReddit.base_url = server.base_url
+    FakeReddit.variants = args.image_variants
+    listing.Reddit = FakeReddit
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config = write_config(
+            data_dir,
+            ["Gather%02d" % index for index in range(args.gather_subreddits)],
+            "submission_limit = %d\nlistings = top:month top:all new\n"
+            % args.gather_limit,
+        )
+        db_session = open_database(config)()
+
+        start = time.perf_counter()
+        Gatherer(config, db_session).download_top_submissions()
+        duration = time.perf_counter() - start
+
+        with open(config.gather_summary, encoding="utf-8") as f_summary:
+            summary = json.load(f_summary)
+
+        db_session.close()
+
+    server.shutdown()
+    server.server_close()
+
+    saved = summary["counters"].get("submissions_saved", 0)
+    downloaded = sum(host["bytes"] for host in summary["hosts"].values())
+
+    return {
+        "duration_ms": duration * 1000,
+        "submissions": saved,
+        "submissions_per_second": saved / duration,
+        "mb_per_second": downloaded / duration / 1024 / 1024,
+        "stages": {
+            stage: timing["seconds"] for stage, timing in summary["stages"].items()
+        },
+    }
+
+
+def print_results(results):
+    """Print benchmark results as a table"""
+    print("%-16s %10s %10s %10s %10s" % ("command", "first", "median", "p95", "ops/s"))
+
+    for name, result in results.items():
+        if name == "gather":
+            continue
+        print(
+            "%-16s %10.1f %10.1f %10.1f %10.1f"
+            % (
+                name,
+                result["first_ms"],
+                result["median_ms"],
+                result["p95_ms"],
+                result["ops_per_second"],
+            )
+        )
+
+    if "gather" in results:
+        result = results["gather"]
+        print(
+            "\ngather: %d submissions in %.1f s, %.1f submissions/s, %.1f MB/s"
+            % (
+                result["submissions"],
+                result["duration_ms"] / 1000,
+                result["submissions_per_second"],
+                result["mb_per_second"],
+            )
+        )
+        for stage, seconds in result["stages"].items():
+            print("%16s %10.3f s" % (stage, seconds))
+
+
+def main():
+    """Run the benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000, help="submissions")
+    parser.add_argument("--subreddits", type=int, default=50, help="subreddits")
+    parser.add_argument("--runs", type=int, default=20, help="runs per command")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--data-dir", help="keep the synthetic database there")
+    parser.add_argument(
+        "--only", action="append", choices=BENCHMARKS, help="benchmarks to run"
+    )
+    parser.add_argument(
+        "--gather-subreddits", type=int, default=4, help="subreddits to gather"
+    )
+    parser.add_argument(
+        "--gather-limit", type=int, default=50, help="submissions per listing"
+    )
+    parser.add_argument(
+        "--image-size", default="1920x1080", help="gathered image dimensions"
+    )
+    parser.add_argument(
+        "--image-variants", type=int, default=8, help="distinct gathered images"
+    )
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    selected = args.only or BENCHMARKS
+    results = {}
+
+    if set(selected) - {"gather"}:
+        if args.data_dir:
+            os.makedirs(args.data_dir, exist_ok=True)
+            results.update(command_benchmarks(args, selected))
+        else:
+            with tempfile.TemporaryDirectory() as data_dir:
+                args.data_dir = data_dir
+                results.update(command_benchmarks(args, selected))
+
+    if "gather" in selected:
+        results["gather"] = gather_benchmark(args)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""Redwall - Command-line startup benchmark
+
+Measures the cold-start time of short-lived commands, i.e. the time spent
+importing modules and opening the database before any work is done, against a
+temporary database holding a single submission.
+
+Usage, from a checkout where the package is installed, e.g. with
+``pip install -e .``:
+
+    $ python scripts/benchmark_startup.py [--runs 10] [--budget 300]
+
+The process exits with a non-zero status if the median wall-clock time of a
+command exceeds the budget, in milliseconds.
+"""
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# a fixed monitor is used by the random command, so that the benchmark does not
+# depend on the display
+RUNNER = """
+import sys
+if "random" in sys.argv:
+    import screeninfo
+    screeninfo.get_monitors = lambda: [screeninfo.Monitor(0, 0, 1920, 1080)]
+from redwall.cli import redwall
+redwall(sys.argv[1:], prog_name="redwall")
+"""
+
+COMMANDS = [
+    ["current", "-f"],
+    ["random"],
+    ["info", "-f", "benchmark"],
+]
+
+IMPORT_TIME_RE = re.compile(r"^import time:\s+\d+ \|\s+(\d+) \| \S")
+
+
+def setup(data_dir):
+    """Create a database holding a single submission"""
+    # pylint: disable=import-outside-toplevel
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    from redwall.migrations import migrate
+    from redwall.models import History, Submission, Subreddit
+
+    engine = create_engine("sqlite:///%s" % os.path.join(data_dir, "redwall.db"))
+    migrate(engine)
+    db_session = sessionmaker(bind=engine)()
+
+    subreddit = Subreddit(name="EarthPorn")
+    db_session.add(subreddit)
+    db_session.flush()
+
+    submission = Submission(
+        subreddit_id=subreddit.id,
+        post_id="benchmark",
+        title="Benchmark",
+        author="redwall",
+        score=1,
+        image_downloaded=True,
+        image_filename=os.path.join(data_dir, "benchmark.jpg"),
+        image_width_px=3840,
+        image_height_px=2160,
+    )
+    db_session.add(submission)
+    db_session.flush()
+
+    db_session.add(History(submission_id=submission.id))
+    db_session.commit()
+    engine.dispose()
+
+
+def run(args, config_path, interpreter_options=()):
+    """Run a redwall command in a new interpreter"""
+    return subprocess.run(
+        [sys.executable, *interpreter_options, "-c", RUNNER, "-c", config_path, *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+
+
+def import_time(args, config_path):
+    """Measure the time spent importing modules, in milliseconds"""
+    result = run(args, config_path, interpreter_options=["-X", "importtime"])
+    total = 0
+
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_RE.match(line)
+        if match:
+            total += int(match.group(1))
+
+    return total / 1000
+
+
+def wall_time(args, config_path, runs):
+    """Measure the median wall-clock time of a command, in milliseconds"""
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        run(args, config_path)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(timings)
+
+
+def baseline(runs):
+    """Measure the startup time of a bare interpreter, in milliseconds"""
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    return statistics.median(timings)
+
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="runs per command")
+    parser.add_argument("--budget", type=float, help="maximum median time, in ms")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        config_path = os.path.join(data_dir, "redwall.ini")
+        with open(config_path, "w", encoding="utf-8") as f_config:
+            f_config.write(
+                "[redwall]\ndata_dir = %s\nsubreddits = EarthPorn\n" % data_dir
+            )
+
+        setup(data_dir)
+
+        print("%-24s %10s %10s" % ("command", "imports", "wall"))
+        print("%-24s %10s %10.1f" % ("python -c pass", "", baseline(args.runs)))
+
+        over_budget = False
+        for command in COMMANDS:
+            imports_ms = import_time(command, config_path)
+            wall_ms = wall_time(command, config_path, args.runs)
+            over_budget |= args.budget is not None and wall_ms > args.budget
+
+            print("%-24s %10.1f %10.1f" % (" ".join(command), imports_ms, wall_ms))
+
+    if over_budget:
+        print("\nStartup budget of %.0f ms exceeded" % args.budget)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,9 @@ setup(
         "screeninfo==0.8",
         "SQLAlchemy>=1.4,<1.5",
     ],
+    extras_require={
+        "postgresql": ["psycopg2>=2.9,<2.10"],
+    },
     classifiers=[
         "Development Status :: 4 - Beta",
         "Environment :: Console",